@@ -0,0 +1,616 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Micro-benchmarks for youtube-dl internals, and an offline end-to-end suite.
+# License: Public domain code
+import BaseHTTPServer
+import SocketServer
+import cgi
+import htmlentitydefs
+import imp
+import json
+import optparse
+import os
+import os.path
+import random
+import re
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+import urlparse
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BASE_DIR, 'fixtures')
+
+ydl = imp.load_source('youtube_dl', os.path.join(BASE_DIR, 'youtube-dld.py'))
+
+def make_downloader(params={}):
+    """Return a FileDownloader with the extractors used by the program."""
+    fd_params = {'quiet': True, 'outtmpl': u'%(id)s.%(ext)s'}
+    fd_params.update(params)
+    fd = ydl.FileDownloader(fd_params)
+    youtube_ie = ydl.YoutubeIE()
+    fd.add_info_extractor(ydl.YoutubeSearchIE(youtube_ie))
+    fd.add_info_extractor(ydl.YoutubePlaylistIE(youtube_ie))
+    fd.add_info_extractor(ydl.MetacafeIE(youtube_ie))
+    fd.add_info_extractor(youtube_ie)
+    return fd
+
+def random_id(length):
+    chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-'
+    return ''.join([random.choice(chars) for i in xrange(length)])
+
+def dispatch_urls(count):
+    """Return count URLs of every kind the extractors handle, and some others."""
+    templates = [
+        lambda: 'http://www.youtube.com/watch?v=%s' % random_id(11),
+        lambda: 'http://www.youtube.com/watch?v=%s&feature=related' % random_id(11),
+        lambda: 'youtube.com/v/%s' % random_id(11),
+        lambda: random_id(11),
+        lambda: 'http://www.youtube.com/view_play_list?p=%s' % random_id(16),
+        lambda: 'http://www.metacafe.com/watch/%d/%s/' % (random.randint(1, 10**7), random_id(20)),
+        lambda: 'http://www.metacafe.com/watch/yt-%s/%s/' % (random_id(11), random_id(20)),
+        lambda: 'ytsearch%d:%s %s' % (random.randint(1, 50), random_id(6), random_id(8)),
+        lambda: 'http://www.example.com/video/%s.flv' % random_id(8),
+        lambda: 'http://%s.youtube.com/user/%s' % (random_id(3), random_id(8)),
+    ]
+    return [random.choice(templates)() for i in xrange(count)]
+
+def linear_find(ies, url):
+    """Find the extractor for url trying every suitable() method in turn."""
+    for ie in ies:
+        if ie.suitable(url):
+            return ie
+    return None
+
+def bench_dispatch(opts):
+    """Measure URL dispatch throughput, indexed against linear scanning."""
+    random.seed(opts.seed)
+    fd = make_downloader()
+    urls = dispatch_urls(opts.count)
+
+    before = time.time()
+    expected = [linear_find(fd._ies, url) for url in urls]
+    linear_time = time.time() - before
+
+    before = time.time()
+    found = [fd._find_info_extractor(url) for url in urls]
+    indexed_time = time.time() - before
+
+    mismatches = [url for url, a, b in zip(urls, expected, found) if a is not b]
+    print 'URLs:            %d' % len(urls)
+    print 'linear scan:     %10.0f URLs/s' % (len(urls) / max(linear_time, 1e-9))
+    print 'indexed:         %10.0f URLs/s' % (len(urls) / max(indexed_time, 1e-9))
+    print 'mismatches:      %d' % len(mismatches)
+    for url in mismatches[:10]:
+        print '  %s' % url
+    return len(mismatches) == 0
+
+def legacy_entity_transform(matchobj):
+    """HTML entity decoding as done before the field extraction engine."""
+    entity = matchobj.group(1)
+    if entity in htmlentitydefs.name2codepoint:
+        return unichr(htmlentitydefs.name2codepoint[entity])
+    mobj = re.match(ur'(?u)#(x?\d+)', entity)
+    if mobj is not None:
+        numstr = mobj.group(1)
+        if numstr.startswith(u'x'):
+            base = 16
+            numstr = u'0%s' % numstr
+        else:
+            base = 10
+        return unichr(long(numstr, base))
+    return (u'&%s;' % entity)
+
+def legacy_youtube_fields(page):
+    """Parse a YouTube watch page searching it once per field."""
+    fields = {}
+    for name, regexp in [
+            ('t', r', "t": "([^"]+)"'),
+            ('uploader', r'<div class="yt-user-info"><a.+>(.+)</a>'),
+            ('title', r'(?im)<title>YouTube - ([^<]*)</title>')]:
+        mobj = re.search(regexp, page)
+        fields[name] = [None, mobj and mobj.group(1)][mobj is not None]
+    title = re.sub(ur'(?u)&(.+?);', legacy_entity_transform, fields['title'].decode('utf-8'))
+    fields['stitle'] = re.sub(ur'(?u)([^%s]+)' % ydl.simple_title_chars, ur'_', title).strip(ur'_')
+    return fields
+
+def youtube_fields(page):
+    """Parse a YouTube watch page with the field extraction engine."""
+    fields = ydl.YoutubeIE._FIELDS.extract(page)
+    title = ydl.FieldExtractor.decode_entities(fields['title'].decode('utf-8'))
+    fields['stitle'] = ydl.FieldExtractor.simplify_title(title)
+    return fields
+
+def legacy_metacafe_fields(page):
+    """Parse a Metacafe watch page searching it once per field."""
+    fields = {}
+    for name, regexp in [
+            ('mediaURL', r'(?m)"mediaURL":"(http.*?\.flv)"'),
+            ('gdaKey', r'(?m)"gdaKey":"(.*?)"'),
+            ('title', r'(?im)<title>(.*) - Video</title>'),
+            ('uploader', r'(?m)<li id="ChnlUsr">.*?Submitter:<br />(.*?)</li>')]:
+        mobj = re.search(regexp, page)
+        fields[name] = [None, mobj and mobj.group(1)][mobj is not None]
+    fields['uploader'] = re.sub(r'<.*?>', '', fields['uploader'])
+    return fields
+
+def metacafe_fields(page):
+    """Parse a Metacafe watch page with the field extraction engine."""
+    fields = ydl.MetacafeIE._FIELDS.extract(page)
+    fields['uploader'] = ydl.MetacafeIE._TAG_RE.sub('', fields['uploader'])
+    return fields
+
+EXTRACT_FIXTURES = [
+    ('youtube_watch.html', legacy_youtube_fields, youtube_fields),
+    ('metacafe_watch.html', legacy_metacafe_fields, metacafe_fields),
+]
+
+def time_calls(function, argument, count):
+    """Return the seconds taken by count calls to function(argument)."""
+    before = time.time()
+    for i in xrange(count):
+        function(argument)
+    return time.time() - before
+
+def bench_extract(opts):
+    """Measure the CPU cost of parsing the saved watch pages."""
+    count = max(opts.count / 100, 1)
+    success = True
+    for fixture, legacy, engine in EXTRACT_FIXTURES:
+        page = open(os.path.join(FIXTURES_DIR, fixture), 'rb').read()
+        expected = legacy(page)
+        found = engine(page)
+        legacy_time = time_calls(legacy, page, count)
+        engine_time = time_calls(engine, page, count)
+        print '%s (%d bytes, %d pages)' % (fixture, len(page), count)
+        print '  separate searches: %8.1f us/page' % (legacy_time * 1e6 / count)
+        print '  field extractor:   %8.1f us/page' % (engine_time * 1e6 / count)
+        if found != expected:
+            success = False
+            print '  MISMATCH: %r != %r' % (found, expected)
+    return success
+
+def archive_keys(count):
+    """Return count video keys, some of them with non-ASCII ids, as byte
+    strings and as unicode strings."""
+    templates = [
+        lambda: ('youtube', random_id(11)),
+        lambda: (u'youtube', unicode(random_id(11))),
+        lambda: ('metacafe', '%d' % random.randint(1, 10**7)),
+        lambda: ('metacafe', 'caf\xc3\xa9-%s' % random_id(8)),
+        lambda: (u'metacafe', u'caf\xe9-%s' % random_id(8)),
+    ]
+    return [random.choice(templates)() for i in xrange(count)]
+
+def bench_archive(opts):
+    """Measure the download archive, and check its records survive reopening it."""
+    random.seed(opts.seed)
+    keys = archive_keys(opts.count)
+    directory = tempfile.mkdtemp(prefix='ydl-bench-')
+    try:
+        filename = os.path.join(directory, 'archive')
+        archive = ydl.DownloadArchive(filename)
+        before = time.time()
+        for key in keys:
+            archive.add(key)
+        add_time = time.time() - before
+
+        archive = ydl.DownloadArchive(filename)
+        before = time.time()
+        missing = [key for key in keys if not archive.contains(key)]
+        contains_time = time.time() - before
+        # Byte string ids are taken as UTF-8, like unicode ones are stored
+        for key in keys:
+            if isinstance(key[1], unicode) and not archive.contains((str(key[0]), key[1].encode('utf-8'))):
+                missing.append(key)
+        known = set(keys)
+        unknown = [key for key in archive_keys(1000) if key not in known and archive.contains(key)]
+    finally:
+        shutil.rmtree(directory, True)
+    print 'records:         %d' % len(keys)
+    print 'add:             %10.0f records/s' % (len(keys) / max(add_time, 1e-9))
+    print 'contains:        %10.0f records/s' % (len(keys) / max(contains_time, 1e-9))
+    print 'missing:         %d' % len(missing)
+    print 'false positives: %d' % len(unknown)
+    for key in (missing + unknown)[:10]:
+        print '  %r' % (key,)
+    return len(missing) == 0 and len(unknown) == 0
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Proxy imitating the YouTube and Metacafe pages the extractors use.
+
+    Every request is answered locally, whatever the host in its URL. The
+    watch pages are built from the saved fixtures, and the video bodies
+    are generated from the video id, honoring Range requests.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, status=200, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', '0'))
+        self.rfile.read(length)
+        self.do_GET()
+
+    def do_GET(self):
+        server = self.server
+        if server.latency > 0:
+            time.sleep(server.latency)
+        url = urlparse.urlsplit(self.path)
+        path = url.path
+        query = dict(cgi.parse_qsl(url.query))
+        host = url.netloc.lower()
+        if path == '/get_video' or path.endswith('.flv'):
+            self.send_video(query.get('video_id', path.split('/')[-1][:-4]))
+        elif 'metacafe' in host and path.startswith('/watch/'):
+            video_id = path.split('/')[2]
+            self.send_body(server.metacafe_page.replace('11362746', video_id))
+        elif path == '/watch':
+            self.send_body(server.youtube_page.replace('IJyn3pRcy_Q', query.get('v', '')))
+        elif path == '/results':
+            self.send_list_page(int(query.get('page', '1')), 'href="/watch?v=s%d_%d"', '<a href="/results?page=%d">Next</a>')
+        elif path == '/view_play_list':
+            playlist_id = query.get('p', '')
+            self.send_list_page(int(query.get('page', '1')), '<a href="/watch?v=p%d_%d&feature=PlayList">',
+                    '/view_play_list?p=' + playlist_id + '&amp;page=%d')
+        else:
+            # Language, login, age confirmation and disclaimer pages
+            self.send_body('<html><body>OK</body></html>')
+
+    def send_list_page(self, page_number, link, next_link):
+        """Serve a search or playlist page with a share of the videos."""
+        server = self.server
+        first = (page_number - 1) * server.page_size
+        count = max(min(server.page_size, server.videos - first), 0)
+        body = [server.padding]
+        for i in xrange(count):
+            body.append(link % (page_number, i))
+            # Pages list every video twice, like the real ones
+            body.append(link % (page_number, i))
+        if first + count < server.videos:
+            body.append(next_link % (page_number + 1))
+        self.send_body('\n'.join(body))
+
+    def send_video(self, video_id):
+        """Serve a video body at the configured bandwidth."""
+        server = self.server
+        size = server.size
+        first = 0
+        last = size - 1
+        status = 200
+        headers = {'Accept-Ranges': 'bytes', 'Content-Type': 'video/x-flv'}
+        mobj = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if mobj is not None:
+            first = int(mobj.group(1))
+            if mobj.group(2) != '':
+                last = min(int(mobj.group(2)), size - 1)
+            if first >= size:
+                self.send_body('', 416, {'Content-Range': 'bytes */%d' % size})
+                return
+            status = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+        failure = None
+        if random.random() < server.fail_rate:
+            failure = random.choice(server.failures)
+        if failure == 'error':
+            self.send_body('Service Unavailable', 503)
+            return
+        length = last - first + 1
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if failure == 'truncate':
+            length = length / 2
+            self.close_connection = 1
+        pattern = ('%-64s' % video_id)[:64] * 1024
+        position = first
+        end = first + length
+        start = time.time()
+        try:
+            while position < end:
+                offset = position % len(pattern)
+                block = pattern[offset:offset + min(end - position, 65536)]
+                self.wfile.write(block)
+                position += len(block)
+                if server.bandwidth > 0:
+                    delay = start + float(position - first) / server.bandwidth - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+        except socket.error:
+            self.close_connection = 1
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded stand-in server (see StandInHandler)."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+    page_size = 20
+
+    def handle_error(self, request, client_address):
+        # Clients drop connections after failures, which is expected here
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def __init__(self, address, opts):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StandInHandler)
+        self.size = opts.size
+        self.latency = opts.latency
+        self.bandwidth = opts.bandwidth
+        self.fail_rate = opts.fail_rate
+        self.failures = {'any': ['error', 'truncate']}.get(opts.failure, [opts.failure])
+        self.videos = opts.videos
+        self.youtube_page = open(os.path.join(FIXTURES_DIR, 'youtube_watch.html'), 'rb').read()
+        self.metacafe_page = open(os.path.join(FIXTURES_DIR, 'metacafe_watch.html'), 'rb').read()
+        # Real result pages are large, though only their links matter
+        self.padding = '<!-- %s -->' % ('.' * 65536)
+
+def serve(opts):
+    """Run the stand-in server until interrupted."""
+    server = StandInServer(('127.0.0.1', opts.port), opts)
+    print 'Serving on 127.0.0.1:%d' % server.server_address[1]
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return True
+
+def start_server(opts):
+    """Start the stand-in server in a child process. Returns (process, port)."""
+    command = [sys.executable, os.path.abspath(__file__), 'serve', '--port', '0',
+            '--size', str(opts.size), '--latency', str(opts.latency), '--bandwidth', str(opts.bandwidth),
+            '--fail-rate', str(opts.fail_rate), '--failure', opts.failure, '--videos', str(opts.videos), '--seed', str(opts.seed)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    line = process.stdout.readline()
+    mobj = re.search(r':(\d+)$', line.strip())
+    if mobj is None:
+        process.terminate()
+        raise RuntimeError('unable to start the stand-in server')
+    return process, int(mobj.group(1))
+
+def percentile(values, fraction):
+    """Return the value below which the given fraction of values fall."""
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+def run_scenario(name, urls, opts, port, latencies):
+    """Download urls through the stand-in server and print the measurements.
+
+    When latencies is True, every URL is downloaded by its own call to
+    download() to measure its latency. Otherwise, all of them are given
+    to a single call, so concurrency options apply.
+    """
+    proxy = 'http://127.0.0.1:%d' % port
+    urllib2.install_opener(urllib2.build_opener(urllib2.ProxyHandler({'http': proxy}), ydl.KeepAliveHandler()))
+    directory = tempfile.mkdtemp(prefix='ydl-bench-')
+    fd = make_downloader()
+    fd.params.update({
+        'outtmpl': os.path.join(directory, u'%(id)s.%(ext)s'),
+        'nooverwrites': False,
+        'ignoreerrors': True,
+        'concurrent': opts.concurrent,
+        'segments': opts.segments,
+        'eventloop': opts.eventloop,
+        'proxy': proxy,
+        })
+    durations = []
+    errors = []
+    trouble = fd.trouble
+    def count_trouble(message=None):
+        errors.append(message)
+        trouble(message)
+    fd.trouble = count_trouble
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    try:
+        if latencies:
+            for url in urls:
+                before = time.time()
+                fd.download([url])
+                durations.append(time.time() - before)
+        else:
+            fd.download(urls)
+        elapsed = time.time() - start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        downloaded = sum([os.path.getsize(os.path.join(directory, filename)) for filename in os.listdir(directory)])
+    finally:
+        shutil.rmtree(directory, True)
+    cpu = (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime)
+    print '%s: %d URLs, %d errors' % (name, len(urls), len(errors))
+    print '  downloaded:   %10.2f MB in %.2f s' % (downloaded / 1048576.0, elapsed)
+    print '  throughput:   %10.2f MB/s' % (downloaded / 1048576.0 / max(elapsed, 1e-9))
+    if latencies:
+        print '  latency:      p50 %.3f s, p90 %.3f s, p99 %.3f s, max %.3f s' % (
+                percentile(durations, 0.5), percentile(durations, 0.9), percentile(durations, 0.99), max(durations))
+    print '  CPU time:     %10.2f s (%.0f%% of wall time)' % (cpu, 100.0 * cpu / max(elapsed, 1e-9))
+    print '  peak RSS:     %10.1f MB' % (usage.ru_maxrss / 1024.0)
+
+def bench_suite(opts):
+    """Run end-to-end downloads against a local stand-in server."""
+    random.seed(opts.seed)
+    process, port = start_server(opts)
+    try:
+        # Dispose of the one-time initialization of the extractors
+        run_scenario('warm-up', ['http://www.youtube.com/watch?v=warmup'], opts, port, False)
+        run_scenario('watch', ['http://www.youtube.com/watch?v=w%05d' % i for i in xrange(opts.videos)], opts, port, True)
+        run_scenario('metacafe', ['http://www.metacafe.com/watch/%d/video_%d/' % (i, i) for i in xrange(opts.videos)], opts, port, True)
+        run_scenario('playlist', ['http://www.youtube.com/view_play_list?p=BENCH'], opts, port, False)
+        run_scenario('search', ['ytsearch%d:benchmark' % opts.videos], opts, port, False)
+    finally:
+        process.terminate()
+        process.wait()
+    return True
+
+def resolve_metadata(urls, opts, port, fast):
+    """Resolve urls through the stand-in server without downloading the
+    videos, as -g does. Returns the video ids, in the order they were
+    resolved, and the seconds taken."""
+    proxy = 'http://127.0.0.1:%d' % port
+    urllib2.install_opener(urllib2.build_opener(urllib2.ProxyHandler({'http': proxy}), ydl.KeepAliveHandler()))
+    directory = tempfile.mkdtemp(prefix='ydl-bench-')
+    dump_filename = os.path.join(directory, 'dump.json')
+    try:
+        fd = make_downloader({
+            'simulate': True,
+            'fastmetadata': fast,
+            'concurrent': opts.concurrent,
+            'proxy': proxy,
+            'dumpjson': dump_filename,
+            })
+        start = time.time()
+        fd.download(urls)
+        elapsed = time.time() - start
+        video_ids = [json.loads(line)['id'] for line in open(dump_filename, 'r')]
+    finally:
+        shutil.rmtree(directory, True)
+    return video_ids, elapsed
+
+def bench_metadata(opts):
+    """Measure the resolution of video URLs without downloading them, one
+    at a time and in fast metadata mode, for watch URLs, a playlist and a
+    search. Use --latency to see the effect of fetching pages at once."""
+    random.seed(opts.seed)
+    page_size = StandInServer.page_size
+    listed = [(i // page_size + 1, i % page_size) for i in xrange(opts.videos)]
+    scenarios = [
+        ('watch', ['http://www.youtube.com/watch?v=w%05d' % i for i in xrange(opts.videos)],
+            ['w%05d' % i for i in xrange(opts.videos)], False),
+        ('playlist', ['http://www.youtube.com/view_play_list?p=BENCH'], ['p%d_%d' % pair for pair in listed], True),
+        ('search', ['ytsearch%d:benchmark' % opts.videos], ['s%d_%d' % pair for pair in listed], True),
+    ]
+    success = True
+    process, port = start_server(opts)
+    try:
+        # Dispose of the one-time initialization of the extractors
+        resolve_metadata(['http://www.youtube.com/watch?v=warmup'], opts, port, False)
+        for name, urls, expected, ordered in scenarios:
+            print '%s: %d videos' % (name, len(expected))
+            for mode, fast in [('sequential', False), ('fast metadata', True)]:
+                video_ids, elapsed = resolve_metadata(urls, opts, port, fast)
+                if not ordered:
+                    # Separate URLs are resolved as they come
+                    video_ids.sort()
+                wrong = ['', ', WRONG RESULTS'][video_ids != expected]
+                print '  %-14s %6.2f s, %8.1f videos/s%s' % (mode + ':', elapsed, len(video_ids) / max(elapsed, 1e-9), wrong)
+                success = success and video_ids == expected
+    finally:
+        process.terminate()
+        process.wait()
+    return success
+
+def check_resume(opts, port, segments):
+    """Download videos through a failing server until they are all complete,
+    resuming the partial files, and check their contents."""
+    proxy = 'http://127.0.0.1:%d' % port
+    urllib2.install_opener(urllib2.build_opener(urllib2.ProxyHandler({'http': proxy}), ydl.KeepAliveHandler()))
+    directory = tempfile.mkdtemp(prefix='ydl-bench-')
+    fd = make_downloader()
+    fd.params.update({
+        'outtmpl': os.path.join(directory, u'%(id)s.%(ext)s'),
+        'nooverwrites': True,
+        'ignoreerrors': True,
+        'segments': segments,
+        })
+    fd.to_stderr = lambda message: None
+    video_ids = ['r%05d' % i for i in xrange(opts.videos)]
+    try:
+        passes = 0
+        while passes < 50:
+            passes += 1
+            if fd.download(['http://www.youtube.com/watch?v=%s' % video_id for video_id in video_ids]) == 0:
+                break
+        corrupt = []
+        for video_id in video_ids:
+            expected = (('%-64s' % video_id)[:64] * (opts.size / 64 + 1))[:opts.size]
+            try:
+                data = open(os.path.join(directory, '%s.flv' % video_id), 'rb').read()
+            except IOError:
+                data = None
+            if data != expected:
+                corrupt.append(video_id)
+    finally:
+        shutil.rmtree(directory, True)
+    print 'resume, %d segments: %d videos in %d passes, %d missing or corrupt' % (segments, len(video_ids), passes, len(corrupt))
+    return len(corrupt) == 0
+
+def bench_resume(opts):
+    """Check that failed downloads, single and segmented, resume correctly."""
+    random.seed(opts.seed)
+    if opts.fail_rate == 0:
+        opts.fail_rate = 0.3
+    process, port = start_server(opts)
+    try:
+        success = check_resume(opts, port, 1)
+        success = check_resume(opts, port, max(opts.segments, 4)) and success
+    finally:
+        process.terminate()
+        process.wait()
+    return success
+
+COMMANDS = {
+    'archive': bench_archive,
+    'dispatch': bench_dispatch,
+    'extract': bench_extract,
+    'metadata': bench_metadata,
+    'resume': bench_resume,
+    'serve': serve,
+    'suite': bench_suite,
+}
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='Usage: %%prog [options] %s' % '|'.join(sorted(COMMANDS)))
+    parser.add_option('-n', '--count',
+            dest='count', metavar='N', type='int', help='number of items to process (default 100000)', default=100000)
+    parser.add_option('--seed',
+            dest='seed', metavar='N', type='int', help='random seed (default 0)', default=0)
+    group = optparse.OptionGroup(parser, 'Stand-in server options (serve, suite, resume, metadata)')
+    group.add_option('--port',
+            dest='port', metavar='PORT', type='int', help='port to listen on (default 48103, 0 for any)', default=48103)
+    group.add_option('--size',
+            dest='size', metavar='BYTES', type='int', help='size of every video (default 4194304)', default=4194304)
+    group.add_option('--latency',
+            dest='latency', metavar='SECS', type='float', help='delay before every response (default 0)', default=0.0)
+    group.add_option('--bandwidth',
+            dest='bandwidth', metavar='BYTES', type='int', help='bytes/s for every video transfer (default 0, unlimited)', default=0)
+    group.add_option('--fail-rate',
+            dest='fail_rate', metavar='P', type='float', help='fraction of video requests failing (default 0, 0.3 for resume)', default=0.0)
+    group.add_option('--failure',
+            dest='failure', metavar='KIND', type='choice', choices=['any', 'error', 'truncate'],
+            help='how video requests fail: error, truncate or any (default)', default='any')
+    group.add_option('--videos',
+            dest='videos', metavar='N', type='int', help='videos per scenario, playlist and search (default 20)', default=20)
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, 'Downloader options (suite, metadata)')
+    group.add_option('--concurrent',
+            dest='concurrent', metavar='N', type='int', help='URLs processed at the same time (default 1)', default=1)
+    group.add_option('--segments',
+            dest='segments', metavar='N', type='int', help='connections per file (default 1)', default=1)
+    group.add_option('--event-loop',
+            action='store_true', dest='eventloop', help='use the event loop engine', default=False)
+    parser.add_option_group(group)
+    (opts, args) = parser.parse_args()
+    if len(args) != 1 or args[0] not in COMMANDS:
+        parser.error('expected one of: %s' % ', '.join(sorted(COMMANDS)))
+    if not COMMANDS[args[0]](opts):
+        sys.exit(1)
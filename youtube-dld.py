@@ -3,20 +3,47 @@
 # Author: Ricardo Garcia Gonzalez
 # Author: Danny Colligan
 # License: Public domain code
+import BaseHTTPServer
+import cPickle
+import cookielib
+import cStringIO
+import collections
+import errno
+import hashlib
+import heapq
 import htmlentitydefs
 import httplib
+import itertools
 import locale
 import math
+import mmap
 import netrc
 import os
 import os.path
 import re
+import select
 import socket
+import sre_constants
+import sre_parse
 import string
 import sys
+import threading
 import time
+import types
 import urllib
 import urllib2
+import urlparse
+import Queue
+
+try:
+    import json
+except ImportError:
+    json = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 std_headers = {
     'User-Agent': 'Mozilla/5.0 (Windows; U; Windows NT 6.0; en-US; rv:1.9.0.8) Gecko/2009032609 Firefox/3.0.8',
@@ -85,24 +112,111 @@ class FileDownloader(object):
     forceurl:    Force printing final URL.
     forcetitle:    Force printing title.
     simulate:    Do not download the video files.
+    fastmetadata:    Only resolve the video information, as fast as possible: implies
+                simulate, runs the event loop engine, skips the initialization
+                requests not needed for public videos and stops reading
+                webpages once the needed fields are found.
     format:        Video format code.
     outtmpl:    Template for output names.
     ignoreerrors:    Do not stop on download errors.
     ratelimit:    Download speed limit, in bytes/sec.
+    hostratelimits:    Dictionary of per-host download speed limits, in bytes/sec.
     nooverwrites:    Prevent overwriting files.
+    concurrent:    Number of URLs (or videos of a single URL) to process at
+                the same time.
+    extractahead:    Number of videos to extract ahead of the downloads.
+    prefetchpages:    Number of search and playlist pages to fetch at the same
+                time.
+    segments:    Number of connections to download each file with.
+    cachedir:    Directory for the extraction cache (None to disable it).
+    cachettl:    Seconds the cached extraction entries remain valid.
+    cachesize:    Maximum size of the extraction cache, in bytes.
+    downloadarchive:    File recording the downloaded videos (None to disable it).
+    postprocessworkers:    Threads running the postprocessing chains (0 to run them
+                in the downloading thread).
+    eventloop:    Use the single-threaded event loop engine.
+    proxy:        HTTP proxy URL for the event loop engine (None for the default).
+    trace:        File to write the timing of every phase to (None to disable it).
+    dumpjson:    File to write the information of every video to, as JSON lines
+                ('-' for stdout, None to disable it).
+    sessionfile:    File keeping the cookies and InfoExtractor sessions between
+                runs (None to keep them in memory only).
+    sessionttl:    Seconds a saved InfoExtractor session remains valid.
+    metricsport:    Local port to serve live metrics on (None to disable it).
+    metricsfile:    File to rewrite with the live metrics periodically (None to
+                disable it).
     """
 
+    _MIN_SEGMENT_SIZE = 1048576 # 1 MB
+
     params = None
     _ies = []
     _pps = []
     _download_retcode = None
+    _cache = None
+    _archive = None
+    _rate_limiter = None
+    _progress_hooks = []
+    _output_lock = None
+    _progress_lines = None
+    _progress_drawn = 0
+    _pp_queue = None
+    _pp_workers = None
+    _pp_failures = None
+    _active_filenames = None
+    _active_lock = None
+    _dispatcher = None
+    _tracer = None
+    _dump = None
+    _metrics = None
+    _cookie_jar = None
+    _session = None
 
     def __init__(self, params):
         """Create a FileDownloader object with the given options."""
         self._ies = []
         self._pps = []
+        self._progress_hooks = []
         self._download_retcode = 0
+        self._output_lock = threading.RLock()
+        self._progress_lines = []
+        self._progress_drawn = 0
+        self._active_filenames = set()
+        self._active_lock = threading.Lock()
         self.params = params
+        self._cache = None
+        if params.get('cachedir', None) is not None:
+            self._cache = ExtractionCache(params['cachedir'],
+                    params.get('cachettl', 3600), params.get('cachesize', 104857600))
+        self._archive = None
+        if params.get('downloadarchive', None) is not None:
+            self._archive = DownloadArchive(params['downloadarchive'])
+        self._rate_limiter = None
+        if params.get('ratelimit', None) is not None or params.get('hostratelimits', None):
+            self._rate_limiter = RateLimiter(params.get('ratelimit', None), params.get('hostratelimits', None))
+        self._cookie_jar = cookielib.CookieJar()
+        self._session = None
+        if params.get('sessionfile', None) is not None:
+            self._session = SessionStore(params['sessionfile'], params.get('sessionttl', 86400), self._cookie_jar)
+        self._tracer = None
+        if params.get('trace', None) is not None:
+            self._tracer = TraceFile(params['trace'])
+        self._dump = None
+        if params.get('dumpjson', None) is not None:
+            self._dump = JSONDump(params['dumpjson'], self._output_lock)
+        self._metrics = None
+        if params.get('metricsport', None) is not None or params.get('metricsfile', None) is not None:
+            self._metrics = Metrics()
+            self.add_progress_hook(self._metrics)
+            if params.get('metricsport', None) is not None:
+                try:
+                    self._metrics.serve(params['metricsport'])
+                except socket.error, err:
+                    self.to_stderr(u'WARNING: unable to serve metrics: %s' % str(err))
+            if params.get('metricsfile', None) is not None:
+                self._metrics.write_periodically(params['metricsfile'])
+        if not params.get('quiet', False):
+            self.add_progress_hook(ProgressRenderer(self))
     
     @staticmethod
     def pmkdir(filename):
@@ -133,25 +247,19 @@ class FileDownloader(object):
         return '%6s' % ('%3.1f%%' % (float(byte_counter) / float(data_len) * 100.0))
 
     @staticmethod
-    def calc_eta(start, now, total, current):
-        if total is None:
-            return '--:--'
-        dif = now - start
-        if current == 0 or dif < 0.001: # One millisecond
+    def format_eta(eta):
+        if eta is None:
             return '--:--'
-        rate = float(current) / dif
-        eta = long((float(total) - float(current)) / rate)
-        (eta_mins, eta_secs) = divmod(eta, 60)
+        (eta_mins, eta_secs) = divmod(long(eta), 60)
         if eta_mins > 99:
             return '--:--'
         return '%02d:%02d' % (eta_mins, eta_secs)
 
     @staticmethod
-    def calc_speed(start, now, bytes):
-        dif = now - start
-        if bytes == 0 or dif < 0.001: # One millisecond
+    def format_speed(speed):
+        if speed is None:
             return '%10s' % '---b/s'
-        return '%10s' % ('%s/s' % FileDownloader.format_bytes(float(bytes) / dif))
+        return '%10s' % ('%s/s' % FileDownloader.format_bytes(speed))
 
     @staticmethod
     def best_block_size(elapsed_time, bytes):
@@ -176,9 +284,70 @@ class FileDownloader(object):
         multiplier = 1024.0 ** 'bkmgtpezy'.index(matchobj.group(2).lower())
         return long(round(number * multiplier))
 
+    def extraction_cache(self):
+        """Returns the extraction cache, or None if it is disabled."""
+        return self._cache
+
+    def download_archive(self):
+        """Returns the download archive, or None if it is disabled."""
+        return self._archive
+
+    def cookie_jar(self):
+        """Returns the cookielib.CookieJar for the requests of this downloader."""
+        return self._cookie_jar
+
+    def session_store(self):
+        """Returns the session store, or None if sessions are not saved."""
+        return self._session
+
+    def cached_page(self, request):
+        """Returns the cached contents of a GET request, or None."""
+        if self._cache is None or request.has_data():
+            return None
+        return self._cache.get(('page', request.get_full_url()))
+
+    def cache_page(self, request, page):
+        """Store the contents of a GET request in the cache, if enabled."""
+        if self._cache is None or request.has_data():
+            return
+        self._cache.put(('page', request.get_full_url()), page)
+
+    def trace_span(self, phase, url, start, outcome='ok', **fields):
+        """Record a phase going from start until now in the trace, if enabled.
+
+        See TraceFile for the phases and the fields of the spans. Spans
+        also feed the live metrics, if enabled.
+        """
+        if self._tracer is None and self._metrics is None:
+            return
+        end = time.time()
+        if self._tracer is not None:
+            self._tracer.write(phase, url, start, end, outcome, fields)
+        if self._metrics is not None:
+            self._metrics.add_span(phase, start, end, outcome, fields)
+
+    def _download_started(self, filename, resume_len):
+        """Account for the start of a video file download. Returns its start time."""
+        if self._metrics is not None:
+            self._metrics.transfer_started(filename, resume_len)
+        return time.time()
+
+    def _download_finished(self, info_dict, filename, tmpfilename, start, outcome):
+        """Account for the end of a video file download started at start."""
+        if self._metrics is not None:
+            self._metrics.transfer_finished(filename)
+        if self._tracer is None and self._metrics is None:
+            return
+        try:
+            size = os.path.getsize(tmpfilename)
+        except OSError:
+            size = None
+        self.trace_span('download', info_dict['url'], start, outcome, bytes=size, id=info_dict['id'])
+
     def add_info_extractor(self, ie):
         """Add an InfoExtractor object to the end of the list."""
         self._ies.append(ie)
+        self._dispatcher = None
         ie.set_downloader(self)
     
     def add_post_processor(self, pp):
@@ -186,16 +355,114 @@ class FileDownloader(object):
         self._pps.append(pp)
         pp.set_downloader(self)
     
+    def add_progress_hook(self, hook):
+        """Add a callable to be notified of the progress of every download.
+
+        The hook receives a dictionary with the following fields:
+
+        status:        "downloading" or "finished".
+        filename:    Final name of the file being downloaded.
+        downloaded_bytes:    Bytes of the file already on disk.
+        total_bytes:    Size of the file, or None if unknown.
+        elapsed:    Seconds since this transfer started.
+        speed:        Bytes/sec of this transfer, or None if unknown.
+        eta:        Seconds until the transfer finishes, or None if unknown.
+
+        Hooks are called from the thread running the download, once per
+        block read, so they should return quickly.
+        """
+        self._progress_hooks.append(hook)
+
+    def _emit_progress(self, status, filename, downloaded_bytes, total_bytes, elapsed, transfer_bytes):
+        """Notify the progress hooks. transfer_bytes excludes resumed data."""
+        speed = None
+        eta = None
+        if transfer_bytes > 0 and elapsed >= 0.001: # One millisecond
+            speed = float(transfer_bytes) / elapsed
+            if total_bytes is not None:
+                eta = (total_bytes - downloaded_bytes) / speed
+        event = {
+            'status':        status,
+            'filename':        filename,
+            'downloaded_bytes':    downloaded_bytes,
+            'total_bytes':    total_bytes,
+            'elapsed':        elapsed,
+            'speed':        speed,
+            'eta':        eta,
+        }
+        for hook in self._progress_hooks:
+            hook(event)
+
     def to_stdout(self, message, skip_eol=False):
         """Print message to stdout if not in quiet mode."""
         if not self.params.get('quiet', False):
-            print u'%s%s' % (message, [u'\n', u''][skip_eol]),
-            sys.stdout.flush()
+            self._output_lock.acquire()
+            try:
+                self._clear_progress_board()
+                print u'%s%s' % (message, [u'\n', u''][skip_eol]),
+                self._draw_progress_board()
+                sys.stdout.flush()
+            finally:
+                self._output_lock.release()
     
+    def _print_forced(self, message):
+        """Print message to stdout, even in quiet mode."""
+        self._output_lock.acquire()
+        try:
+            print message
+            sys.stdout.flush()
+        finally:
+            self._output_lock.release()
+
     def to_stderr(self, message):
         """Print message to stderr."""
-        print >>sys.stderr, message
+        self._output_lock.acquire()
+        try:
+            self._clear_progress_board()
+            print >>sys.stderr, message
+            self._draw_progress_board()
+            sys.stdout.flush()
+        finally:
+            self._output_lock.release()
+
+    def concurrent_mode(self):
+        """Checks if several URLs may be processed at the same time."""
+        return (self.params.get('concurrent', 1) > 1)
+
+    def _clear_progress_board(self):
+        """Erase the per-transfer progress lines from the terminal."""
+        if self._progress_drawn > 0:
+            sys.stdout.write('\r\x1b[%dA\x1b[J' % self._progress_drawn)
+            self._progress_drawn = 0
+
+    def _draw_progress_board(self):
+        """Print one progress line per active transfer below the output."""
+        if self._progress_drawn > 0 or len(self._progress_lines) == 0:
+            return
+        for key, line in self._progress_lines:
+            print u'%s\x1b[K' % line
+        self._progress_drawn = len(self._progress_lines)
     
+    @staticmethod
+    def temp_name(filename):
+        """Returns a temporary filename for the given filename."""
+        if os.path.exists(filename) and not os.path.isfile(filename):
+            return filename
+        return filename + u'.part'
+
+    def try_rename(self, old_filename, new_filename):
+        """Rename a file, replacing the destination. Returns True on success."""
+        if old_filename == new_filename:
+            return True
+        try:
+            if os.name == 'nt' and os.path.exists(new_filename):
+                os.remove(new_filename)
+            os.rename(old_filename, new_filename)
+        except (OSError, IOError), err:
+            self.trouble(u'ERROR: unable to rename file: %s' % str(err))
+            return False
+        return True
+
     def fixed_template(self):
         """Checks if the output template is fixed."""
         return (re.search(ur'(?u)%\(.+?\)s', self.params['outtmpl']) is None)
@@ -213,42 +480,147 @@ class FileDownloader(object):
             raise DownloadError(message)
         self._download_retcode = 1
 
-    def slow_down(self, start_time, byte_counter):
-        """Sleep if the download speed is over the rate limit."""
-        rate_limit = self.params.get('ratelimit', None)
-        if rate_limit is None or byte_counter == 0:
-            return
-        now = time.time()
-        elapsed = now - start_time
-        if elapsed <= 0.0:
-            return
-        speed = float(byte_counter) / elapsed
-        if speed > rate_limit:
-            time.sleep((byte_counter - rate_limit * (now - start_time)) / rate_limit)
+    def slow_down(self, host, byte_count):
+        """Sleep as needed to keep every download under the rate limits."""
+        if self._rate_limiter is not None:
+            self._rate_limiter.consume(host, byte_count)
+
+    def rate_limit_delay(self, host, byte_count):
+        """Account for downloaded bytes, returning the seconds to pause for."""
+        if self._rate_limiter is None:
+            return 0.0
+        return self._rate_limiter.reserve(host, byte_count)
+
+    def limit_block_size(self, host, block_size):
+        """Reduce a block size so reading it does not burst over the rate limits."""
+        if self._rate_limiter is None:
+            return block_size
+        return min(block_size, self._rate_limiter.max_block_size(host))
+
+    @staticmethod
+    def read_batch_file(batchfd):
+        """Yield the URLs in a batch file, one per non-blank line."""
+        for line in batchfd:
+            line = line.strip()
+            if line != '':
+                yield line
+
+    @staticmethod
+    def url_host(url):
+        """Returns the lowercase host name of a URL."""
+        host = urllib.splithost(urllib.splittype(url)[1])[0] or ''
+        return urllib.splitport(host)[0].lower()
 
     def report_destination(self, filename):
         """Report destination filename."""
         self.to_stdout(u'[download] Destination: %s' % filename)
+
+    def report_resuming_byte(self, resume_len):
+        """Report attempt to resume at given byte."""
+        self.to_stdout(u'[download] Resuming download at byte %s' % resume_len)
+
+    def report_unable_to_resume(self):
+        """Report it was impossible to resume download."""
+        self.to_stdout(u'[download] Unable to resume')
+
+    def report_duplicate_url(self, url):
+        """Report a URL skipped because its video was already seen."""
+        self.to_stdout(u'[download] Skipping repeated video: %s' % url)
+
+    def report_file_already_downloaded(self, filename):
+        """Report file has already been fully downloaded."""
+        self.to_stdout(u'[download] %s has already been downloaded' % filename)
     
-    def report_progress(self, percent_str, data_len_str, speed_str, eta_str):
+    def report_progress(self, percent_str, data_len_str, speed_str, eta_str, key=None):
         """Report download progress."""
-        self.to_stdout(u'\r[download] %s of %s at %s ETA %s' %
-                (percent_str, data_len_str, speed_str, eta_str), skip_eol=True)
+        if key is None or not self.concurrent_mode():
+            self.to_stdout(u'\r[download] %s of %s at %s ETA %s' %
+                    (percent_str, data_len_str, speed_str, eta_str), skip_eol=True)
+            return
+        if self.params.get('quiet', False) or not sys.stdout.isatty():
+            return
+        line = u'[download] %s: %s of %s at %s ETA %s' % (os.path.basename(key),
+                percent_str, data_len_str, speed_str, eta_str)
+        self._output_lock.acquire()
+        try:
+            self._clear_progress_board()
+            for i in xrange(len(self._progress_lines)):
+                if self._progress_lines[i][0] == key:
+                    self._progress_lines[i] = (key, line)
+                    break
+            else:
+                self._progress_lines.append((key, line))
+            self._draw_progress_board()
+            sys.stdout.flush()
+        finally:
+            self._output_lock.release()
     
-    def report_finish(self):
+    def report_finish(self, key=None):
         """Report download finished."""
-        self.to_stdout(u'')
+        if key is None or not self.concurrent_mode():
+            self.to_stdout(u'')
+            return
+        self._output_lock.acquire()
+        try:
+            self._clear_progress_board()
+            self._progress_lines = [x for x in self._progress_lines if x[0] != key]
+            self._draw_progress_board()
+        finally:
+            self._output_lock.release()
+        self.to_stdout(u'[download] Finished: %s' % key)
 
     def process_info(self, info_dict):
         """Process a single dictionary returned by an InfoExtractor."""
+        download = self._prepare_download(info_dict)
+        if download is None:
+            return
+        filename, tmpfilename, outstream, resume_len = download
+        try:
+            start = self._download_started(filename, resume_len)
+            outcome = 'error'
+            try:
+                try:
+                    outstream.start(resume_len)
+                    self._do_download(outstream, info_dict['url'], filename, resume_len)
+                    outstream.close()
+                    outstream.finish()
+                    outcome = 'ok'
+                except (OSError, IOError), err:
+                    outstream.abort()
+                    self.trouble('ERROR: unable to write video data: %s' % str(err))
+                    return
+                except (urllib2.URLError, httplib.HTTPException, socket.error, ValueError), err:
+                    outstream.abort()
+                    self.trouble('ERROR: unable to download video data: %s' % str(err))
+                    return
+                except (PostProcessingError), err:
+                    outstream.abort()
+                    self.trouble('ERROR: postprocessing: %s' % str(err))
+                    return
+            finally:
+                self._download_finished(info_dict, filename, tmpfilename, start, outcome)
+            self._complete_download(info_dict, filename, tmpfilename)
+        finally:
+            self._release_filename(filename)
+
+    def _prepare_download(self, info_dict):
+        """Do everything needed before downloading the video data.
+
+        Returns a (filename, temporary filename, output stream, resume
+        length) tuple, or None if there is nothing to download. The
+        filename is then claimed until _release_filename() is called, and
+        videos resolving to a filename already claimed are skipped.
+        """
         # Forced printings
         if self.params.get('forcetitle', False):
-            print info_dict['title']
+            self._print_forced(info_dict['title'])
         if self.params.get('forceurl', False):
-            print info_dict['url']
+            self._print_forced(info_dict['url'])
+        if self._dump is not None:
+            self._dump.write(info_dict)
             
         # Do nothing else if in simulate mode
-        if self.params.get('simulate', False):
+        if self.params.get('simulate', False) or self.params.get('fastmetadata', False):
             return
 
         try:
@@ -256,74 +628,395 @@ class FileDownloader(object):
             self.report_destination(filename)
         except (ValueError, KeyError), err:
             self.trouble('ERROR: invalid output template or system charset: %s' % str(err))
-        if self.params['nooverwrites'] and os.path.exists(filename):
-            self.to_stderr('WARNING: file exists: %s; skipping' % filename)
+        if not self._claim_filename(filename):
+            self.to_stderr('WARNING: file is already being downloaded: %s; skipping' % filename)
             return
         try:
+            if self.params['nooverwrites'] and os.path.exists(filename):
+                self.to_stderr('WARNING: file exists: %s; skipping' % filename)
+                self._release_filename(filename)
+                return
             self.pmkdir(filename)
         except (OSError, IOError), err:
+            self._release_filename(filename)
             self.trouble('ERROR: unable to create directories: %s' % str(err))
             return
+        tmpfilename = self.temp_name(filename)
         try:
-            outstream = open(filename, 'wb')
+            resume_len = 0
+            if tmpfilename != filename and os.path.isfile(tmpfilename):
+                resume_len = os.path.getsize(tmpfilename)
+            outstream = open(tmpfilename, ['wb', 'ab'][resume_len > 0])
         except (OSError, IOError), err:
+            self._release_filename(filename)
             self.trouble('ERROR: unable to open for writing: %s' % str(err))
             return
+        info = dict(info_dict)
+        info['filepath'] = filename
+        outstream = PostProcessingStream(outstream, tmpfilename, self._pps, info)
+        return (filename, tmpfilename, outstream, resume_len)
+
+    def _claim_filename(self, filename):
+        """Mark filename as being downloaded. Returns False if it already is."""
+        self._active_lock.acquire()
         try:
-            self._do_download(outstream, info_dict['url'])
-            outstream.close()
-        except (OSError, IOError), err:
-            self.trouble('ERROR: unable to write video data: %s' % str(err))
-            return
-        except (urllib2.URLError, httplib.HTTPException, socket.error), err:
-            self.trouble('ERROR: unable to download video data: %s' % str(err))
-            return
+            if filename in self._active_filenames:
+                return False
+            self._active_filenames.add(filename)
+            return True
+        finally:
+            self._active_lock.release()
+
+    def _release_filename(self, filename):
+        """Mark filename as no longer being downloaded."""
+        self._active_lock.acquire()
         try:
-            self.post_process(filename, info_dict)
-        except (PostProcessingError), err:
-            self.trouble('ERROR: postprocessing: %s' % str(err))
+            self._active_filenames.discard(filename)
+        finally:
+            self._active_lock.release()
+
+    def _complete_download(self, info_dict, filename, tmpfilename):
+        """Move a downloaded file into place and postprocess it."""
+        if not self.try_rename(tmpfilename, filename):
             return
+        if self._pp_queue is None:
+            self._post_process_file(filename, info_dict)
+        else:
+            self._queue_post_processing(filename, info_dict)
+
+    def _post_process_file(self, filename, info_dict):
+        """Run the postprocessing chain on a downloaded file and archive it."""
+        start = time.time()
+        outcome = 'error'
+        try:
+            try:
+                self.post_process(filename, info_dict)
+                outcome = 'ok'
+            except (PostProcessingError), err:
+                self.trouble('ERROR: postprocessing: %s' % str(err))
+                return
+        finally:
+            if len(self._pps) > 0:
+                self.trace_span('postprocess', filename, start, outcome, id=info_dict['id'])
 
-        return
+        self.record_download_archive(info_dict)
+
+    def record_download_archive(self, info_dict):
+        """Add a successfully processed video to the download archive."""
+        if self._archive is None or info_dict.get('extractor', None) is None:
+            return
+        try:
+            self._archive.add((info_dict['extractor'], info_dict['id']))
+        except (OSError, IOError), err:
+            self.trouble(u'ERROR: unable to update download archive: %s' % str(err))
 
     def download(self, url_list):
-        """Download a given list of URLs."""
-        if len(url_list) > 1 and self.fixed_template():
+        """Download a given list of URLs.
+
+        The list can be any iterable, which is consumed as the downloads
+        progress. URLs referring to a video already seen are skipped.
+        Returns 1 if there were errors while downloading them, 0 otherwise.
+        """
+        self._download_retcode = 0
+        url_iter = self._unique_urls(url_list)
+        first_urls = list(itertools.islice(url_iter, 2))
+        if len(first_urls) > 1 and self.fixed_template():
             raise SameFileError(self.params['outtmpl'])
+        url_list = itertools.chain(first_urls, url_iter)
 
-        for url in url_list:
-            suitable_found = False
-            for ie in self._ies:
-                # Go to next InfoExtractor if not suitable
-                if not ie.suitable(url):
-                    continue
+        self._start_post_processing()
+        try:
+            if self.params.get('eventloop', False) or self.params.get('fastmetadata', False):
+                EventLoopEngine(self).run(url_list)
+            elif self.params.get('extractahead', 0) > 0:
+                self._download_pipelined(url_list)
+            elif self.concurrent_mode() and len(first_urls) > 1:
+                self._run_workers(url_list, lambda item: self._process_url(*item), self.params['concurrent'])
+            elif self.concurrent_mode() and len(first_urls) == 1:
+                # A single URL, like a playlist, is extracted here while
+                # the workers download its videos
+                self._run_workers(self._extract_url(*first_urls[0]), self.process_info, self.params['concurrent'])
+            else:
+                for url, ie in url_list:
+                    self._process_url(url, ie)
+        except:
+            self._stop_post_processing(False)
+            self._save_state()
+            raise
+        self._stop_post_processing(True)
+        self._save_state()
+
+        return self._download_retcode
+
+    def _save_state(self):
+        """Save the session and the final metrics, and flush the JSON dump, if enabled."""
+        if self._dump is not None:
+            self._dump.flush()
+        if self._session is not None:
+            self._session.save()
+        if self._metrics is not None and self.params.get('metricsfile', None) is not None:
+            self._metrics.write_file(self.params['metricsfile'])
+
+    def _start_post_processing(self):
+        """Start the postprocessing threads, if requested.
+
+        Downloaded files wait in a queue holding as many files as there are
+        threads, so the downloads block instead of piling up unprocessed
+        files on disk when the postprocessors fall behind.
+        """
+        num_workers = self.params.get('postprocessworkers', 0)
+        if num_workers < 1 or len(self._pps) == 0:
+            return
+        self._pp_queue = Queue.Queue(num_workers)
+        self._pp_failures = []
+        self._pp_workers = []
+        for i in xrange(num_workers):
+            thread = threading.Thread(target=self._post_processing_worker, name='postprocess-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self._pp_workers.append(thread)
+
+    def _post_processing_worker(self):
+        """Run the postprocessing chains of the queued files."""
+        while True:
+            item = self._pp_queue.get()
+            if item is None:
+                break
+            if len(self._pp_failures) > 0:
+                continue
+            try:
+                self._post_process_file(*item)
+            except Exception:
+                self._pp_failures.append(sys.exc_info())
 
-                # Suitable InfoExtractor found
-                suitable_found = True
+    @staticmethod
+    def _queue_put(queue, item):
+        """Put an item in a Queue.Queue, waiting for room."""
+        # Wait with a timeout so KeyboardInterrupt reaches the main thread
+        while True:
+            try:
+                queue.put(item, True, 0.5)
+                return
+            except Queue.Full:
+                pass
 
-                # Extract information from URL
-                all_results = ie.extract(url)
-                results = [x for x in all_results if x is not None]
+    @staticmethod
+    def _queue_get(queue):
+        """Get an item from a Queue.Queue, waiting for one."""
+        # Wait with a timeout so KeyboardInterrupt reaches the main thread
+        while True:
+            try:
+                return queue.get(True, 0.5)
+            except Queue.Empty:
+                pass
+
+    def _put_post_processing(self, item):
+        """Put an item in the postprocessing queue, waiting for room."""
+        self._queue_put(self._pp_queue, item)
+
+    def _raise_post_processing_failure(self):
+        """Raise again the first exception raised by a postprocessing thread."""
+        if len(self._pp_failures) > 0:
+            exc_type, exc_value, exc_traceback = self._pp_failures[0]
+            raise exc_type, exc_value, exc_traceback
+
+    def _queue_post_processing(self, filename, info_dict):
+        """Hand a downloaded file over to the postprocessing threads."""
+        self._raise_post_processing_failure()
+        self._put_post_processing((filename, info_dict))
+
+    def _stop_post_processing(self, wait):
+        """Stop the postprocessing threads.
+
+        If wait is True, the queued files are processed first, and an
+        exception raised while processing them is raised again here.
+        Otherwise, the files still in the queue are left unprocessed.
+        """
+        if self._pp_queue is None:
+            return
+        if not wait:
+            self._pp_failures.append(None)
+        for thread in self._pp_workers:
+            self._put_post_processing(None)
+        for thread in self._pp_workers:
+            while thread.isAlive():
+                thread.join(0.5)
+        self._pp_queue = None
+        if wait:
+            self._raise_post_processing_failure()
+
+    def _unique_urls(self, url_list):
+        """Yield a (URL, InfoExtractor) pair for every URL in url_list,
+        skipping repeated videos.
+
+        The InfoExtractor is the one _find_info_extractor() returns for
+        the URL (None if there is none), so URLs are dispatched only once.
+        URLs are compared by the (extractor, video id) pair their
+        InfoExtractor gives for them, so different forms of the URL of a
+        video count as the same one. Only a short digest of every pair is
+        kept, to bound the memory used on very long lists.
+        """
+        seen = set()
+        for url in url_list:
+            ie = self._find_info_extractor(url)
+            if ie is not None:
+                video_key = ie._video_key(url)
+                if video_key is not None:
+                    digest = hashlib.sha1(repr(video_key)).digest()[:10]
+                    if digest in seen:
+                        self.report_duplicate_url(url)
+                        continue
+                    seen.add(digest)
+            yield (url, ie)
+
+    def _find_info_extractor(self, url):
+        """Return the first InfoExtractor suitable for url, or None."""
+        dispatcher = self._dispatcher
+        if dispatcher is None:
+            dispatcher = URLDispatcher(self._ies)
+            self._dispatcher = dispatcher
+        return dispatcher.find(url)
+
+    def _process_url(self, url, ie):
+        """Extract the information from a URL and process every result.
+
+        ie is the InfoExtractor for the URL, as returned by
+        _find_info_extractor(). Each result is processed as soon as it is
+        extracted, so only one of them is kept in memory at a time.
+        """
+        for result in self._extract_url(url, ie):
+            self.process_info(result)
 
-                # See if there were problems extracting any information
-                if len(results) != len(all_results):
-                    self.trouble()
+    def _extract_url(self, url, ie):
+        """Yield the results for a URL as its InfoExtractor, ie, produces them.
 
-                # Two results could go to the same file
-                if len(results) > 1 and self.fixed_template():
-                    raise SameFileError(self.params['outtmpl'])
+        Extraction problems are reported through trouble() as soon as they
+        are found, and a SameFileError is raised before yielding a second
+        result when the output template is fixed.
+        """
+        if ie is None:
+            self.trouble('ERROR: no suitable InfoExtractor: %s' % url)
+            return
 
-                # Process each result
-                for result in results:
-                    self.process_info(result)
+        num_results = 0
+        for result in ie.extract_iter(url):
+            if result is None:
+                self.trouble()
+                continue
+            num_results += 1
+            if num_results > 1 and self.fixed_template():
+                raise SameFileError(self.params['outtmpl'])
+            yield result
+
+    def _download_pipelined(self, url_list):
+        """Overlap extraction and downloads using a bounded queue.
+
+        A separate thread extracts the information for every URL and puts
+        the results in a queue holding at most "extractahead" entries, so
+        extraction blocks when it gets that far ahead. The calling thread
+        (or a pool of workers in concurrent mode) processes the results as
+        soon as they are available. Exceptions raised in either stage stop
+        both of them and are raised again here.
+        """
+        extracted = Queue.Queue(self.params['extractahead'])
+        extraction_failures = []
+        stopped = []
 
-                # Suitable InfoExtractor had been found; go to next URL
+        def extraction_stage():
+            try:
+                try:
+                    for url, ie in url_list:
+                        for result in self._extract_url(url, ie):
+                            extracted.put(result)
+                            if len(stopped) > 0:
+                                return
+                except Exception:
+                    extraction_failures.append(sys.exc_info())
+            finally:
+                extracted.put(None)
+
+        def results():
+            while len(extraction_failures) == 0:
+                result = self._queue_get(extracted)
+                if result is None:
+                    break
+                yield result
+
+        thread = threading.Thread(target=extraction_stage, name='extraction')
+        thread.setDaemon(True)
+        thread.start()
+
+        interrupted = False
+        try:
+            try:
+                if self.concurrent_mode():
+                    self._run_workers(results(), self.process_info, self.params['concurrent'])
+                else:
+                    for result in results():
+                        self.process_info(result)
+            except KeyboardInterrupt:
+                interrupted = True
+                raise
+        finally:
+            # Unblock the extraction stage if it is waiting for room. When
+            # interrupted, the daemon thread is left to die with the program
+            # instead of waiting for the extraction in progress.
+            stopped.append(True)
+            while thread.isAlive() and not interrupted:
+                try:
+                    extracted.get(True, 0.5)
+                except Queue.Empty:
+                    pass
+
+        if len(extraction_failures) > 0:
+            exc_type, exc_value, exc_traceback = extraction_failures[0]
+            raise exc_type, exc_value, exc_traceback
+
+    def _run_workers(self, items, function, num_workers):
+        """Call function on every element of items using worker threads.
+
+        The first exception raised by a worker (a DownloadError when not
+        ignoring errors, a SameFileError, etc) stops the scheduling of new
+        items and is raised again in the calling thread once every worker
+        has finished its current item.
+        """
+        pending = Queue.Queue(num_workers * 2)
+        failures = []
+
+        def worker():
+            while True:
+                item = pending.get()
+                if item is None:
+                    break
+                if len(failures) > 0:
+                    continue
+                try:
+                    function(item)
+                except Exception:
+                    failures.append(sys.exc_info())
+
+        workers = []
+        for i in xrange(num_workers):
+            thread = threading.Thread(target=worker, name='download-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            workers.append(thread)
+
+        for item in items:
+            if len(failures) > 0:
                 break
+            self._queue_put(pending, item)
+        for thread in workers:
+            self._queue_put(pending, None)
 
-            if not suitable_found:
-                self.trouble('ERROR: no suitable InfoExtractor: %s' % url)
+        # Join with a timeout so KeyboardInterrupt reaches the main thread
+        for thread in workers:
+            while thread.isAlive():
+                thread.join(0.5)
 
-        return self._download_retcode
+        if len(failures) > 0:
+            exc_type, exc_value, exc_traceback = failures[0]
+            raise exc_type, exc_value, exc_traceback
 
     def post_process(self, filename, ie_info):
         """Run the postprocessing chain on the given file."""
@@ -334,38 +1027,357 @@ class FileDownloader(object):
             if info is None:
                 break
     
-    def _do_download(self, stream, url):
+    def _segment_ranges(self, headers):
+        """Split a download in byte ranges if the server allows it.
+
+        Returns a list of (first, last) byte positions, or None if the file
+        has to be downloaded in a single stream.
+        """
+        num_segments = self.params.get('segments', 1)
+        data_len = headers.get('Content-length', None)
+        if num_segments < 2 or data_len is None:
+            return None
+        if headers.get('Accept-ranges', '').lower() != 'bytes':
+            return None
+        data_len = long(data_len)
+        num_segments = min(num_segments, data_len / self._MIN_SEGMENT_SIZE)
+        if num_segments < 2:
+            return None
+        segment_size = data_len / num_segments
+        ranges = []
+        for i in xrange(num_segments):
+            ranges.append((i * segment_size, (i + 1) * segment_size - 1))
+        ranges[-1] = (ranges[-1][0], data_len - 1)
+        return ranges
+
+    def _do_download(self, stream, url, key=None, resume_len=0):
+        """Download url into stream.
+
+        If resume_len is not zero, stream holds the first resume_len bytes
+        of a previous, interrupted download and only the rest of the file
+        is requested. When the server does not honor that request, stream
+        is restarted and the whole file is downloaded again.
+        """
+        host = self.url_host(url)
         request = urllib2.Request(url, None, std_headers)
-        data = urllib2.urlopen(request)
+        if resume_len > 0:
+            self.report_resuming_byte(resume_len)
+            request.add_header('Range', 'bytes=%d-' % resume_len)
+        try:
+            data = urllib2.urlopen(request)
+        except urllib2.HTTPError, err:
+            if resume_len == 0 or err.code != 416:
+                raise
+            # Unable to resume (requested range not satisfiable)
+            data = urllib2.urlopen(urllib2.Request(url, None, std_headers))
+            if data.info().get('Content-length', None) == str(resume_len):
+                # The file had already been fully downloaded
+                data.close()
+                self.report_file_already_downloaded(key)
+                return
+            self.report_unable_to_resume()
+            resume_len = 0
+            stream.restart()
+        if resume_len > 0:
+            mobj = re.match(r'bytes (\d+)-', data.info().get('Content-range', ''))
+            if mobj is None or long(mobj.group(1)) != resume_len:
+                self.report_unable_to_resume()
+                if mobj is not None:
+                    data.close()
+                    data = urllib2.urlopen(urllib2.Request(url, None, std_headers))
+                resume_len = 0
+                stream.restart()
+        if resume_len == 0:
+            ranges = self._segment_ranges(data.info())
+            if ranges is not None and self._do_segmented_download(stream, url, data, ranges, key):
+                return
         data_len = data.info().get('Content-length', None)
-        data_len_str = self.format_bytes(data_len)
+        total_len = None
+        if data_len is not None:
+            data_len = long(data_len)
+            total_len = data_len + resume_len
         byte_counter = 0
         block_size = 1024
+        receiver = ReceiveBuffer(data)
+        progress_hooks = self._progress_hooks
         start = time.time()
+        if progress_hooks:
+            self._emit_progress('downloading', key, resume_len, total_len, 0.0, 0)
         while True:
-            # Progress message
-            percent_str = self.calc_percent(byte_counter, data_len)
-            eta_str = self.calc_eta(start, time.time(), data_len, byte_counter)
-            speed_str = self.calc_speed(start, time.time(), byte_counter)
-            self.report_progress(percent_str, data_len_str, speed_str, eta_str)
-
             # Download and write
             before = time.time()
-            data_block = data.read(block_size)
+            data_block = receiver.read(block_size)
             after = time.time()
             data_block_len = len(data_block)
             if data_block_len == 0:
                 break
             byte_counter += data_block_len
             stream.write(data_block)
-            block_size = self.best_block_size(after - before, data_block_len)
+            block_size = self.limit_block_size(host, self.best_block_size(after - before, data_block_len))
+
+            # Progress report
+            if progress_hooks:
+                self._emit_progress('downloading', key, byte_counter + resume_len, total_len, after - start, byte_counter)
 
             # Apply rate limit
-            self.slow_down(start, byte_counter)
+            self.slow_down(host, data_block_len)
+
+        if progress_hooks:
+            self._emit_progress('finished', key, byte_counter + resume_len, total_len, time.time() - start, byte_counter)
+        if data_len is not None and byte_counter != data_len:
+            raise ValueError('Content too short: %s/%s bytes' % (byte_counter + resume_len, total_len))
 
-        self.report_finish()
-        if data_len is not None and str(byte_counter) != data_len:
-            raise ValueError('Content too short: %s/%s bytes' % (byte_counter, data_len))
+    def _do_segmented_download(self, stream, url, data, ranges, key=None):
+        """Download the byte ranges of a file in parallel.
+
+        The output file is preallocated and every range is fetched by its
+        own thread with an HTTP Range request, writing its blocks at their
+        final position. The first range reuses the already opened response
+        in data. Progress is reported from the calling thread.
+
+        Returns False without writing anything if the server does not
+        honor the request for the second range.
+        """
+        responses = [data, self._open_range(url, ranges[1][0], ranges[1][1])]
+        if responses[1] is None:
+            return False
+        responses.extend([None] * (len(ranges) - 2))
+
+        host = self.url_host(url)
+        data_len = ranges[-1][1] + 1
+        stream.truncate(data_len)
+        write_lock = threading.Lock()
+        byte_counter = [0]
+        positions = [first for (first, last) in ranges]
+        failures = []
+        start = time.time()
+
+        def fetch(index, first, last, response):
+            try:
+                if response is None:
+                    response = self._open_range(url, first, last)
+                    if response is None:
+                        raise ValueError('Range request not honored by server')
+                position = first
+                block_size = 1024
+                receiver = ReceiveBuffer(response)
+                while position <= last and len(failures) == 0:
+                    before = time.time()
+                    data_block = receiver.read(min(block_size, last - position + 1))
+                    after = time.time()
+                    data_block_len = len(data_block)
+                    if data_block_len == 0:
+                        break
+                    write_lock.acquire()
+                    try:
+                        if len(failures) > 0:
+                            break
+                        stream.seek(position)
+                        stream.write(data_block)
+                        byte_counter[0] += data_block_len
+                        positions[index] += data_block_len
+                    finally:
+                        write_lock.release()
+                    position += data_block_len
+                    block_size = self.limit_block_size(host, self.best_block_size(after - before, data_block_len))
+
+                    # Apply rate limit
+                    self.slow_down(host, data_block_len)
+                response.close()
+            except Exception:
+                failures.append(sys.exc_info())
+
+        threads = []
+        for i in xrange(len(ranges)):
+            first, last = ranges[i]
+            thread = threading.Thread(target=fetch, args=(i, first, last, responses[i]))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for thread in threads:
+                while thread.isAlive():
+                    # Progress report
+                    self._emit_progress('downloading', key, byte_counter[0], data_len, time.time() - start, byte_counter[0])
+                    thread.join(0.5)
+        except:
+            failures.append(sys.exc_info())
+
+        if len(failures) == 0 and byte_counter[0] != data_len:
+            try:
+                raise ValueError('Content too short: %s/%s bytes' % (byte_counter[0], data_len))
+            except ValueError:
+                failures.append(sys.exc_info())
+
+        if len(failures) > 0:
+            # Keep only the bytes that can be resumed from, as the file
+            # was preallocated and has holes where segments fell short
+            write_lock.acquire()
+            try:
+                failures.append(None)
+                complete_len = 0
+                for i in xrange(len(ranges)):
+                    complete_len = positions[i]
+                    if positions[i] <= ranges[i][1]:
+                        break
+                stream.truncate(complete_len)
+            finally:
+                write_lock.release()
+            exc_type, exc_value, exc_traceback = failures[0]
+            raise exc_type, exc_value, exc_traceback
+        self._emit_progress('finished', key, byte_counter[0], data_len, time.time() - start, byte_counter[0])
+        return True
+
+    def _open_range(self, url, first, last):
+        """Request a byte range of url. Returns None if it is not honored."""
+        request = urllib2.Request(url, None, std_headers)
+        request.add_header('Range', 'bytes=%d-%d' % (first, last))
+        response = urllib2.urlopen(request)
+        if response.info().get('Content-range', None) is None:
+            response.close()
+            return None
+        return response
+
+class PageRequest(urllib2.Request):
+    """Request for a webpage that is only needed until some fields are found.
+
+    Extraction steps can yield it instead of a urllib2.Request. The page
+    is then read a block at a time, and reading stops as soon as
+    complete(page) returns True for the text received up to its last
+    full line, which becomes the contents of the page. Pages cut short
+    this way are never cached.
+    """
+
+    block_size = 16384
+
+    complete = None
+
+    def __init__(self, url, data=None, headers={}, complete=None):
+        urllib2.Request.__init__(self, url, data, headers)
+        self.complete = complete
+
+    def truncate(self, received):
+        """Returns received up to its last full line if complete, or None."""
+        end = received.rfind('\n') + 1
+        if end == 0 or self.complete is None:
+            return None
+        page = received[:end]
+        if not self.complete(page):
+            return None
+        return page
+
+    def read(self, response):
+        """Read the page from response. Returns it and whether it was cut short."""
+        received = ''
+        while True:
+            data = response.read(self.block_size)
+            if data == '':
+                return (received, False)
+            received += data
+            page = self.truncate(received)
+            if page is not None:
+                response.close()
+                return (page, True)
+
+class FieldExtractor(object):
+    """Extracts several fields from a webpage.
+
+    It receives a list of (name, regexp) pairs, where the first group of
+    each regular expression is the value of the field. The expressions are
+    compiled once, and when one starts with literal text, the page is
+    scanned for that text with a plain substring search, much faster than
+    the one done by the regular expression engine, before trying to match
+    the expression where it is found. The extract() method returns a
+    dictionary with the value of every field, or None for the fields not
+    found, exactly as if re.search() had been called for each of them.
+    """
+
+    _ENTITY_RE = re.compile(ur'(?u)&(.+?);')
+    _NUMERIC_ENTITY_RE = re.compile(ur'#(?:x([0-9a-fA-F]+)|(\d+))$')
+    _ENTITY_TABLE = dict([(name, unichr(codepoint)) for name, codepoint in htmlentitydefs.name2codepoint.iteritems()])
+    _SIMPLE_TITLE_RE = re.compile(ur'(?u)([^%s]+)' % simple_title_chars)
+
+    _fields = None
+
+    def __init__(self, fields):
+        self._fields = [(name, re.compile(regexp), self.literal_prefix(regexp)) for name, regexp in fields]
+
+    @staticmethod
+    def literal_prefix(regexp):
+        """Return the literal text any match of regexp starts with."""
+        parsed = sre_parse.parse(regexp)
+        if parsed.pattern.flags & (re.IGNORECASE | re.LOCALE | re.UNICODE):
+            return ''
+        prefix = []
+        for opcode, argument in parsed:
+            if opcode != sre_constants.LITERAL:
+                break
+            prefix.append(chr(argument))
+        return ''.join(prefix)
+
+    @staticmethod
+    def search(compiled, prefix, page):
+        """Same as compiled.search(page), given the literal prefix of compiled."""
+        if prefix == '':
+            return compiled.search(page)
+        position = page.find(prefix)
+        while position >= 0:
+            mobj = compiled.match(page, position)
+            if mobj is not None:
+                return mobj
+            position = page.find(prefix, position + 1)
+        return None
+
+    def extract(self, page):
+        """Return a dictionary with the value of every field in page."""
+        values = {}
+        for name, compiled, prefix in self._fields:
+            mobj = self.search(compiled, prefix, page)
+            if mobj is None:
+                values[name] = None
+            else:
+                values[name] = mobj.group(1)
+        return values
+
+    def found_all(self, page):
+        """Return True if every field is in page."""
+        for name, compiled, prefix in self._fields:
+            if self.search(compiled, prefix, page) is None:
+                return False
+        return True
+
+    @classmethod
+    def entity_transform(cls, matchobj):
+        """Transforms an HTML entity to a Unicode character."""
+        entity = matchobj.group(1)
+
+        # Known non-numeric HTML entity
+        character = cls._ENTITY_TABLE.get(entity, None)
+        if character is not None:
+            return character
+
+        # Unicode character
+        mobj = cls._NUMERIC_ENTITY_RE.match(entity)
+        if mobj is not None:
+            if mobj.group(1) is not None:
+                return unichr(int(mobj.group(1), 16))
+            return unichr(int(mobj.group(2)))
+
+        # Unknown entity in name, return its literal representation
+        return (u'&%s;' % entity)
+
+    @classmethod
+    def decode_entities(cls, text):
+        """Replace the HTML entities in text with the characters they represent."""
+        if u'&' not in text:
+            return text
+        return cls._ENTITY_RE.sub(cls.entity_transform, text)
+
+    @classmethod
+    def simplify_title(cls, title):
+        """Return the simplified version of a title used in file names."""
+        return cls._SIMPLE_TITLE_RE.sub(ur'_', title).strip(ur'_')
 
 class InfoExtractor(object):
     """Information Extractor class.
@@ -374,9 +1386,11 @@ class InfoExtractor(object):
     information from the video (or videos) the URL refers to. This
     information includes the real video URL, the video title and simplified
     title, author and others. It is returned in a list of dictionaries when
-    calling its extract() method. It is a list because a URL can refer to
-    more than one video (think of playlists). The dictionaries must include
-    the following fields:
+    calling its extract() method, or one dictionary at a time by the
+    iterator returned by extract_iter(), which keeps memory bounded for
+    long playlists. It is a list because a URL can refer to more than one
+    video (think of playlists). The dictionaries must include the following
+    fields:
 
     id:        Video identifier.
     url:        Final video URL.
@@ -385,18 +1399,56 @@ class InfoExtractor(object):
     stitle:        Simplified title.
     ext:        Video filename extension.
 
+    Dictionaries may also include an "extractor" field naming the
+    extractor that produced them, matching the first element of the pairs
+    returned by _video_key(), so downloaded videos can be recorded in the
+    download archive.
+
     Subclasses of this one should re-define the _real_initialize() and
     _real_extract() methods, as well as the suitable() static method.
     Probably, they should also be instantiated and added to the main
     downloader.
+
+    When _real_initialize() only sets up cookies, subclasses can also
+    define _session_key() and make _real_initialize() return True when it
+    succeeds. If the downloader saves sessions, initialization is then
+    skipped while the saved session for the same key remains valid.
+
+    Instead of _real_extract(), subclasses can define _extract_steps(), a
+    generator that does not access the network itself. It yields a
+    urllib2.Request for every webpage it needs, receiving the contents
+    of the page as the value of the yield expression (or the exception
+    raised while fetching it), and yields the dictionaries, or None on
+    errors, as they are extracted. It can also yield another generator of
+    steps, like the one returned by extract_steps() for other URLs, to run
+    it at that point. A list of requests can be yielded too, to start
+    fetching them in the background: the value of the yield expression is
+    None, and yielding one of those requests afterwards returns its page
+    (or raises its exception) as soon as it is available. Requests from a
+    list that are never yielded are ignored. A PageRequest, like the ones
+    returned by _webpage_request(), stands for a page only needed until
+    some fields are found. The pages can then be fetched in a blocking
+    way by extract_iter(), or without blocking by an event loop.
+
+    Subclasses whose suitable() method just matches the URL against their
+    _VALID_URL regular expression can also define _URL_HOSTS, the tuple of
+    host names they accept URLs from (subdomains included), with an empty
+    string for text that is not a URL, like a bare video id. The downloader
+    then only tries them for URLs of those hosts, testing all the candidate
+    extractors with a single combined expression.
     """
 
+    _VALID_URL = None
+    _URL_HOSTS = None
+
     _ready = False
     _downloader = None
+    _init_lock = None
 
     def __init__(self, downloader=None):
         """Constructor. Receives an optional downloader."""
         self._ready = False
+        self._init_lock = threading.Lock()
         self.set_downloader(downloader)
 
     @staticmethod
@@ -406,35 +1458,339 @@ class InfoExtractor(object):
 
     def initialize(self):
         """Initializes an instance (authentication, etc)."""
-        if not self._ready:
-            self._real_initialize()
-            self._ready = True
+        if self._ready:
+            return
+        self._init_lock.acquire()
+        try:
+            if not self._ready:
+                start = time.time()
+                outcome = 'error'
+                session_key = self._session_key()
+                store = None
+                if session_key is not None and self._downloader is not None:
+                    store = self._downloader.session_store()
+                try:
+                    if store is not None and store.is_valid(session_key):
+                        self.report_saved_session(session_key)
+                        outcome = 'session'
+                    else:
+                        if self._real_initialize() and store is not None:
+                            store.add(session_key)
+                        outcome = 'ok'
+                    self._ready = True
+                finally:
+                    self._trace_span('initialize', None, start, outcome)
+        finally:
+            self._init_lock.release()
 
     def extract(self, url):
         """Extracts URL information and returns it in list of dicts."""
+        return list(self.extract_iter(url))
+
+    def extract_iter(self, url):
+        """Extracts URL information and returns an iterator over the dicts.
+
+        Each dictionary is produced as soon as it is available, so the
+        caller can start processing the first one before the rest have
+        been extracted.
+        """
+        return self.run_steps(self.extract_steps(url))
+
+    def extract_steps(self, url, parent=None, flatten=True):
+        """Returns the extraction steps for a URL (see _extract_steps()).
+
+        Nested generators are already run in the returned steps, which
+        only yield requests and results, unless flatten is False: the
+        extraction steps of other URLs, like the videos of a playlist,
+        are then yielded too, for the caller to run them, and the results
+        of the URL are not cached. When the steps are to be nested in the
+        extraction of another URL, parent is that URL.
+        """
+        start = time.time()
+        video_key = self._video_key(url)
+        if video_key is not None and self._downloader is not None:
+            archive = self._downloader.download_archive()
+            if archive is not None and archive.contains(video_key):
+                self.report_already_in_archive(video_key)
+                self._trace_span('extract', url, start, 'archived', parent=parent)
+                return
+
+        cache_key = self._result_cache_key(video_key)
+        if cache_key is not None:
+            results = self._downloader.extraction_cache().get(cache_key)
+            if results is not None:
+                self.report_cached_information(cache_key[1:3])
+                self._trace_span('extract', url, start, 'cached', results=len(results), parent=parent)
+                for result in results:
+                    yield result
+                return
+
         self.initialize()
-        return self._real_extract(url)
+        if flatten:
+            steps = self.flatten_steps(self._extract_steps(url))
+        else:
+            steps = self.flatten_steps(self._extract_steps(url), self.is_extraction)
+        # Results are only kept to be cached, which playlists never are
+        results = []
+        num_results = 0
+        num_failures = 0
+        reply = None
+        error = None
+        # Time spent running the extractor itself, without fetching pages
+        parse_time = 0.0
+        outcome = 'error'
+        try:
+            while True:
+                before = time.time()
+                try:
+                    step = self.resume_steps(steps, reply, error)
+                except StopIteration:
+                    break
+                parse_time += time.time() - before
+                reply = None
+                error = None
+                if isinstance(step, types.GeneratorType):
+                    # The results of the nested steps are not seen here
+                    cache_key = None
+                    yield step
+                elif isinstance(step, (urllib2.Request, list)):
+                    try:
+                        reply = yield step
+                    except Exception:
+                        error = sys.exc_info()
+                else:
+                    if step is None:
+                        num_failures += 1
+                    else:
+                        num_results += 1
+                    if cache_key is not None:
+                        results.append(step)
+                    yield step
+            outcome = ['error', 'ok'][num_failures == 0]
+        finally:
+            self._trace_span('extract', url, start, outcome, results=num_results, parse_time=parse_time, parent=parent)
+        if cache_key is not None and outcome == 'ok':
+            self._downloader.extraction_cache().put(cache_key, results)
+
+    @staticmethod
+    def resume_steps(steps, reply, error):
+        """Returns the next step, sending reply or throwing error into steps."""
+        if error is None:
+            return steps.send(reply)
+        return steps.throw(*error)
+
+    @staticmethod
+    def is_extraction(steps):
+        """Checks if a generator of steps was returned by extract_steps()."""
+        return steps.gi_code is InfoExtractor.extract_steps.im_func.func_code
+
+    @classmethod
+    def flatten_steps(cls, steps, keep=None):
+        """Returns steps with the nested generators of steps run in place.
+
+        Exceptions raised by a nested generator are thrown into the one
+        that yielded it. If keep is given, the nested generators for which
+        it returns True are yielded instead.
+        """
+        stack = [steps]
+        reply = None
+        error = None
+        while len(stack) > 0:
+            try:
+                step = cls.resume_steps(stack[-1], reply, error)
+            except StopIteration:
+                stack.pop()
+                reply = None
+                error = None
+                continue
+            except Exception:
+                stack.pop()
+                if len(stack) == 0:
+                    raise
+                reply = None
+                error = sys.exc_info()
+                continue
+            reply = None
+            error = None
+            if isinstance(step, types.GeneratorType) and (keep is None or not keep(step)):
+                stack.append(step)
+            elif isinstance(step, (urllib2.Request, list, types.GeneratorType)):
+                try:
+                    reply = yield step
+                except Exception:
+                    error = sys.exc_info()
+            else:
+                yield step
+
+    def run_steps(self, steps):
+        """Run extraction steps, fetching their pages. Yields the results."""
+        reply = None
+        error = None
+        prefetched = {}
+        while True:
+            try:
+                step = self.resume_steps(steps, reply, error)
+            except StopIteration:
+                return
+            reply = None
+            error = None
+            if isinstance(step, list):
+                for request in step:
+                    if request not in prefetched:
+                        prefetched[request] = self._prefetch_page(request)
+            elif isinstance(step, urllib2.Request):
+                prefetch = prefetched.pop(step, None)
+                try:
+                    if prefetch is None:
+                        reply = self._fetch_page(step)
+                    else:
+                        reply = prefetch()
+                except Exception:
+                    error = sys.exc_info()
+            else:
+                yield step
+
+    def _prefetch_page(self, request):
+        """Fetch a page in a new thread. Returns a function waiting for its contents."""
+        result = []
+        def fetch():
+            try:
+                result.append((self._fetch_page(request), None))
+            except Exception:
+                result.append((None, sys.exc_info()))
+        thread = threading.Thread(target=fetch, name='prefetch')
+        thread.setDaemon(True)
+        thread.start()
+        def wait():
+            # Join with a timeout so KeyboardInterrupt reaches the main thread
+            while thread.isAlive():
+                thread.join(0.5)
+            page, error = result[0]
+            if error is not None:
+                raise error[0], error[1], error[2]
+            return page
+        return wait
 
     def set_downloader(self, downloader):
         """Sets the downloader for this IE."""
         self._downloader = downloader
     
+    def report_already_in_archive(self, video_key):
+        """Report video skipped because it is in the download archive."""
+        self._downloader.to_stdout(u'[%s] %s: Already recorded in download archive; skipping' % video_key)
+
+    def report_saved_session(self, session_key):
+        """Report initialization skipped thanks to a saved session."""
+        self._downloader.to_stdout(u'[%s] Using saved session' % session_key[0])
+
+    def report_cached_information(self, video_key):
+        """Report use of cached video information."""
+        self._downloader.to_stdout(u'[%s] %s: Using cached video information' % video_key)
+
+    def _video_key(self, url):
+        """Returns an (extractor, video id) pair for the URL, or None.
+
+        The pair must be computed without network access. Extractors
+        handling URLs that refer to a single video should redefine it.
+        """
+        return None
+
+    def _prefetch_window(self):
+        """Returns the number of pages to fetch at the same time."""
+        if self._downloader is None:
+            return 1
+        return self._downloader.params.get('prefetchpages', 1)
+
+    def _session_key(self):
+        """Returns a key identifying the session set up by _real_initialize().
+
+        The key is a tuple starting with the extractor name, followed by
+        anything that makes the session different, like the account used.
+        Returns None if the initialization can not be skipped.
+        """
+        return None
+
+    def _result_cache_key(self, video_key):
+        """Returns the extraction cache key for a video key, or None."""
+        if self._downloader is None or self._downloader.extraction_cache() is None:
+            return None
+        if video_key is None:
+            return None
+        return ('result',) + tuple(video_key) + (self._downloader.params.get('format', None),)
+
+    def _trace_span(self, phase, url, start, outcome='ok', **fields):
+        """Record a phase of this IE in the downloader trace, if enabled."""
+        if self._downloader is not None:
+            self._downloader.trace_span(phase, url, start, outcome, ie=self.__class__.__name__, **fields)
+
+    def _fetch_page(self, request):
+        """Returns the contents of a GET request, using the cache if enabled."""
+        if self._downloader is None:
+            response = urllib2.urlopen(request)
+            if isinstance(request, PageRequest):
+                return request.read(response)[0]
+            return response.read()
+        start = time.time()
+        page = self._downloader.cached_page(request)
+        if page is not None:
+            self._downloader.trace_span('fetch', request.get_full_url(), start, 'cached', bytes=len(page))
+            return page
+        truncated = False
+        try:
+            response = urllib2.urlopen(request)
+            if isinstance(request, PageRequest):
+                page, truncated = request.read(response)
+            else:
+                page = response.read()
+        except:
+            self._downloader.trace_span('fetch', request.get_full_url(), start, 'error')
+            raise
+        self._downloader.trace_span('fetch', request.get_full_url(), start, ['ok', 'truncated'][truncated], bytes=len(page))
+        if not truncated:
+            self._downloader.cache_page(request, page)
+        return page
+
+    def _webpage_request(self, url, fields, headers={}):
+        """Returns the request for a webpage to extract fields from.
+
+        fields is a FieldExtractor. In fast metadata mode the page is only
+        read until all of them are found (see PageRequest).
+        """
+        if self._downloader is not None and self._downloader.params.get('fastmetadata', False):
+            return PageRequest(url, None, headers, fields.found_all)
+        return urllib2.Request(url, None, headers)
+
     def _real_initialize(self):
-        """Real initialization process. Redefine in subclasses."""
+        """Real initialization process. Redefine in subclasses.
+
+        Returns True if the session it set up can be saved (see
+        _session_key()).
+        """
         pass
 
     def _real_extract(self, url):
         """Real extraction process. Redefine in subclasses."""
         pass
 
+    def _extract_steps(self, url):
+        """Real extraction process, as steps. Runs _real_extract() by default."""
+        for result in self._real_extract(url):
+            yield result
+
 class YoutubeIE(InfoExtractor):
     """Information extractor for youtube.com."""
 
-    _VALID_URL = r'^((?:http://)?(?:\w+\.)?youtube\.com/(?:(?:v/)|(?:(?:watch(?:\.php)?)?\?(?:.+&)?v=)))?([0-9A-Za-z_-]+)(?(1).+)?$'
+    _VALID_URL = r'^(?P<youtube_prefix>(?:http://)?(?:\w+\.)?youtube\.com/(?:(?:v/)|(?:(?:watch(?:\.php)?)?\?(?:.+&)?v=)))?([0-9A-Za-z_-]+)(?(youtube_prefix).+)?$'
+    _URL_HOSTS = ('youtube.com', '')
     _LANG_URL = r'http://www.youtube.com/?hl=en&persist_hl=1&gl=US&persist_gl=1&opt_out_ackd=1'
     _LOGIN_URL = 'http://www.youtube.com/signup?next=/&gl=US&hl=en'
     _AGE_URL = 'http://www.youtube.com/verify_age?next_url=/&gl=US&hl=en'
     _NETRC_MACHINE = 'youtube'
+    _FIELDS = FieldExtractor([
+        ('t', r', "t": "([^"]+)"'),
+        ('uploader', r'<div class="yt-user-info"><a.+>(.+)</a>'),
+        ('title', r'(?im)<title>YouTube - ([^<]*)</title>'),
+        ])
 
     @staticmethod
     def suitable(url):
@@ -443,25 +1799,23 @@ class YoutubeIE(InfoExtractor):
     @staticmethod
     def htmlentity_transform(matchobj):
         """Transforms an HTML entity to a Unicode character."""
-        entity = matchobj.group(1)
+        return FieldExtractor.entity_transform(matchobj)
 
-        # Known non-numeric HTML entity
-        if entity in htmlentitydefs.name2codepoint:
-            return unichr(htmlentitydefs.name2codepoint[entity])
-
-        # Unicode character
-        mobj = re.match(ur'(?u)#(x?\d+)', entity)
-        if mobj is not None:
-            numstr = mobj.group(1)
-            if numstr.startswith(u'x'):
-                base = 16
-                numstr = u'0%s' % numstr
-            else:
-                base = 10
-            return unichr(long(numstr, base))
+    def _video_key(self, url):
+        mobj = re.match(self._VALID_URL, url)
+        if mobj is None:
+            return None
+        return ('youtube', mobj.group(2))
 
-        # Unknown entity in name, return its literal representation
-        return (u'&%s;' % entity)
+    def _session_key(self):
+        if self._downloader is None:
+            return None
+        downloader_params = self._downloader.params
+        if downloader_params.get('username', None) is not None:
+            return ('youtube', downloader_params['username'])
+        if downloader_params.get('usenetrc', False):
+            return ('youtube', '.netrc')
+        return ('youtube', None)
 
     def report_lang(self):
         """Report attempt to set language."""
@@ -511,6 +1865,10 @@ class YoutubeIE(InfoExtractor):
                 self._downloader.trouble(u'WARNING: parsing .netrc: %s' % str(err))
                 return
 
+        # Watch page URLs already set the language, which is only needed to log in
+        if username is None and downloader_params.get('fastmetadata', False):
+            return
+
         # Set language
         request = urllib2.Request(self._LANG_URL, None, std_headers)
         try:
@@ -522,7 +1880,7 @@ class YoutubeIE(InfoExtractor):
 
         # No authentication to be performed
         if username is None:
-            return
+            return True
 
         # Log in
         login_form = {
@@ -555,13 +1913,15 @@ class YoutubeIE(InfoExtractor):
         except (urllib2.URLError, httplib.HTTPException, socket.error), err:
             self._downloader.trouble(u'ERROR: unable to confirm age: %s' % str(err))
             return
+        return True
 
-    def _real_extract(self, url):
+    def _extract_steps(self, url):
         # Extract video id from URL
         mobj = re.match(self._VALID_URL, url)
         if mobj is None:
             self._downloader.trouble(u'ERROR: invalid URL: %s' % url)
-            return [None]
+            yield None
+            return
         video_id = mobj.group(2)
 
         # Downloader parameters
@@ -581,60 +1941,69 @@ class YoutubeIE(InfoExtractor):
         normalized_url = 'http://www.youtube.com/watch?v=%s&gl=US&hl=en' % video_id
         if format_param is not None:
             normalized_url = '%s&fmt=%s' % (normalized_url, format_param)
-        request = urllib2.Request(normalized_url, None, std_headers)
+        request = self._webpage_request(normalized_url, self._FIELDS, std_headers)
         try:
             self.report_webpage_download(video_id)
-            video_webpage = urllib2.urlopen(request).read()
+            video_webpage = yield request
         except (urllib2.URLError, httplib.HTTPException, socket.error), err:
             self._downloader.trouble(u'ERROR: unable to download video webpage: %s' % str(err))
-            return [None]
+            yield None
+            return
         self.report_information_extraction(video_id)
+        fields = self._FIELDS.extract(video_webpage)
         
         # "t" param
-        mobj = re.search(r', "t": "([^"]+)"', video_webpage)
-        if mobj is None:
+        if fields['t'] is None:
             self._downloader.trouble(u'ERROR: unable to extract "t" parameter')
-            return [None]
-        video_real_url = 'http://www.youtube.com/get_video?video_id=%s&t=%s&el=detailpage&ps=' % (video_id, mobj.group(1))
+            yield None
+            return
+        video_real_url = 'http://www.youtube.com/get_video?video_id=%s&t=%s&el=detailpage&ps=' % (video_id, fields['t'])
         if format_param is not None:
             video_real_url = '%s&fmt=%s' % (video_real_url, format_param)
         self.report_video_url(video_id, video_real_url)
 
         # uploader
-        mobj = re.search(r'<div class="yt-user-info"><a.+>(.+)</a>', video_webpage)
-        if mobj is None:
+        if fields['uploader'] is None:
             self._downloader.trouble(u'ERROR: unable to extract uploader nickname')
-            return [None]
-        video_uploader = mobj.group(1)
+            yield None
+            return
+        video_uploader = fields['uploader']
 
         # title
-        mobj = re.search(r'(?im)<title>YouTube - ([^<]*)</title>', video_webpage)
-        if mobj is None:
+        if fields['title'] is None:
             self._downloader.trouble(u'ERROR: unable to extract video title')
-            return [None]
-        video_title = mobj.group(1).decode('utf-8')
-        video_title = re.sub(ur'(?u)&(.+?);', self.htmlentity_transform, video_title)
+            yield None
+            return
+        video_title = FieldExtractor.decode_entities(fields['title'].decode('utf-8'))
         video_title = video_title.replace(os.sep, u'%')
 
         # simplified title
-        simple_title = re.sub(ur'(?u)([^%s]+)' % simple_title_chars, ur'_', video_title)
-        simple_title = simple_title.strip(ur'_')
+        simple_title = FieldExtractor.simplify_title(video_title)
 
         # Process video information
-        return [{
+        yield {
             'id':        video_id.decode('utf-8'),
             'url':        video_real_url.decode('utf-8'),
             'uploader':    video_uploader.decode('utf-8'),
             'title':    video_title,
             'stitle':    simple_title,
             'ext':        video_extension.decode('utf-8'),
-            }]
+            'extractor':    u'youtube',
+            }
 
 class MetacafeIE(InfoExtractor):
     """Information Extractor for metacafe.com."""
 
     _VALID_URL = r'(?:http://)?(?:www\.)?metacafe\.com/watch/([^/]+)/([^/]+)/.*'
+    _URL_HOSTS = ('metacafe.com',)
     _DISCLAIMER = 'http://www.metacafe.com/family_filter/'
+    _FIELDS = FieldExtractor([
+        ('mediaURL', r'(?m)"mediaURL":"(http.*?\.flv)"'),
+        ('gdaKey', r'(?m)"gdaKey":"(.*?)"'),
+        ('title', r'(?im)<title>(.*) - Video</title>'),
+        ('uploader', r'(?m)<li id="ChnlUsr">.*?Submitter:<br />(.*?)</li>'),
+        ])
+    _TAG_RE = re.compile(r'<.*?>')
     _youtube_ie = None
 
     def __init__(self, youtube_ie, downloader=None):
@@ -645,6 +2014,18 @@ class MetacafeIE(InfoExtractor):
     def suitable(url):
         return (re.match(MetacafeIE._VALID_URL, url) is not None)
 
+    def _video_key(self, url):
+        mobj = re.match(self._VALID_URL, url)
+        if mobj is None:
+            return None
+        video_id = mobj.group(1)
+        if video_id.startswith('yt-'):
+            return ('youtube', video_id[3:])
+        return ('metacafe', video_id)
+
+    def _session_key(self):
+        return ('metacafe',)
+
     def report_disclaimer(self):
         """Report disclaimer retrieval."""
         self._downloader.to_stdout(u'[metacafe] Retrieving disclaimer')
@@ -662,6 +2043,10 @@ class MetacafeIE(InfoExtractor):
         self._downloader.to_stdout(u'[metacafe] %s: Extracting information' % video_id)
 
     def _real_initialize(self):
+        # The family filter is only needed for adult videos
+        if self._downloader is not None and self._downloader.params.get('fastmetadata', False):
+            return
+
         # Retrieve disclaimer
         request = urllib2.Request(self._DISCLAIMER, None, std_headers)
         try:
@@ -683,75 +2068,83 @@ class MetacafeIE(InfoExtractor):
         except (urllib2.URLError, httplib.HTTPException, socket.error), err:
             self._downloader.trouble(u'ERROR: unable to confirm age: %s' % str(err))
             return
+        return True
     
-    def _real_extract(self, url):
+    def _extract_steps(self, url):
         # Extract id and simplified title from URL
         mobj = re.match(self._VALID_URL, url)
         if mobj is None:
             self._downloader.trouble(u'ERROR: invalid URL: %s' % url)
-            return [None]
+            yield None
+            return
 
         video_id = mobj.group(1)
 
         # Check if video comes from YouTube
         mobj2 = re.match(r'^yt-(.*)$', video_id)
         if mobj2 is not None:
-            return self._youtube_ie.extract('http://www.youtube.com/watch?v=%s' % mobj2.group(1))
+            yield self._youtube_ie.extract_steps('http://www.youtube.com/watch?v=%s' % mobj2.group(1), url)
+            return
 
         simple_title = mobj.group(2).decode('utf-8')
         video_extension = 'flv'
 
         # Retrieve video webpage to extract further information
-        request = urllib2.Request('http://www.metacafe.com/watch/%s/' % video_id)
+        request = self._webpage_request('http://www.metacafe.com/watch/%s/' % video_id, self._FIELDS)
         try:
             self.report_download_webpage(video_id)
-            webpage = urllib2.urlopen(request).read()
+            webpage = yield request
         except (urllib2.URLError, httplib.HTTPException, socket.error), err:
             self._downloader.trouble(u'ERROR: unable retrieve video webpage: %s' % str(err))
-            return [None]
+            yield None
+            return
 
         # Extract URL, uploader and title from webpage
         self.report_extraction(video_id)
-        mobj = re.search(r'(?m)"mediaURL":"(http.*?\.flv)"', webpage)
-        if mobj is None:
+        fields = self._FIELDS.extract(webpage)
+        if fields['mediaURL'] is None:
             self._downloader.trouble(u'ERROR: unable to extract media URL')
-            return [None]
-        mediaURL = mobj.group(1).replace('\\', '')
+            yield None
+            return
+        mediaURL = fields['mediaURL'].replace('\\', '')
 
-        mobj = re.search(r'(?m)"gdaKey":"(.*?)"', webpage)
-        if mobj is None:
+        if fields['gdaKey'] is None:
             self._downloader.trouble(u'ERROR: unable to extract gdaKey')
-            return [None]
-        gdaKey = mobj.group(1)
+            yield None
+            return
+        gdaKey = fields['gdaKey']
 
         video_url = '%s?__gda__=%s' % (mediaURL, gdaKey)
 
-        mobj = re.search(r'(?im)<title>(.*) - Video</title>', webpage)
-        if mobj is None:
+        if fields['title'] is None:
             self._downloader.trouble(u'ERROR: unable to extract title')
-            return [None]
-        video_title = mobj.group(1).decode('utf-8')
+            yield None
+            return
+        video_title = fields['title'].decode('utf-8')
 
-        mobj = re.search(r'(?m)<li id="ChnlUsr">.*?Submitter:<br />(.*?)</li>', webpage)
-        if mobj is None:
+        if fields['uploader'] is None:
             self._downloader.trouble(u'ERROR: unable to extract uploader nickname')
-            return [None]
-        video_uploader = re.sub(r'<.*?>', '', mobj.group(1))
+            yield None
+            return
+        video_uploader = self._TAG_RE.sub('', fields['uploader'])
 
         # Return information
-        return [{
+        yield {
             'id':        video_id.decode('utf-8'),
             'url':        video_url.decode('utf-8'),
             'uploader':    video_uploader.decode('utf-8'),
             'title':    video_title,
             'stitle':    simple_title,
             'ext':        video_extension.decode('utf-8'),
-            }]
+            'extractor':    u'metacafe',
+            }
 
 
 class YoutubeSearchIE(InfoExtractor):
     """Information Extractor for YouTube search queries."""
     _VALID_QUERY = r'ytsearch(\d+|all)?:[\s\S]+'
+    _VALID_URL = _VALID_QUERY
+    _URL_HOSTS = ('',)
     _TEMPLATE_URL = 'http://www.youtube.com/results?search_query=%s&page=%s&gl=US&hl=en'
     _VIDEO_INDICATOR = r'href="/watch\?v=.+?"'
     _MORE_PAGES_INDICATOR = r'>Next</a>'
@@ -773,73 +2166,94 @@ class YoutubeSearchIE(InfoExtractor):
     def _real_initialize(self):
         self._youtube_ie.initialize()
     
-    def _real_extract(self, query):
+    def _extract_steps(self, query):
         mobj = re.match(self._VALID_QUERY, query)
         if mobj is None:
             self._downloader.trouble(u'ERROR: invalid search query "%s"' % query)
-            return [None]
+            yield None
+            return
 
+        search = query
         prefix, query = query.split(':')
         prefix = prefix[8:]
         if prefix == '':
-            return self._download_n_results(query, 1)
+            yield self._download_n_results(query, 1, search)
         elif prefix == 'all':
-            return self._download_n_results(query, self._max_youtube_results)
+            yield self._download_n_results(query, self._max_youtube_results, search)
         else:
             try:
                 n = int(prefix)
-                if n <= 0:
-                    self._downloader.trouble(u'ERROR: invalid download number %s for query "%s"' % (n, query))
-                    return [None]
-                elif n > self._max_youtube_results:
-                    self._downloader.trouble(u'WARNING: ytsearch returns max %i results (you requested %i)'  % (self._max_youtube_results, n))
-                    n = self._max_youtube_results
-                return self._download_n_results(query, n)
             except ValueError: # parsing prefix as int fails
-                return self._download_n_results(query, 1)
+                yield self._download_n_results(query, 1, search)
+                return
+            if n <= 0:
+                self._downloader.trouble(u'ERROR: invalid download number %s for query "%s"' % (n, query))
+                yield None
+                return
+            elif n > self._max_youtube_results:
+                self._downloader.trouble(u'WARNING: ytsearch returns max %i results (you requested %i)'  % (self._max_youtube_results, n))
+                n = self._max_youtube_results
+            yield self._download_n_results(query, n, search)
 
-    def _download_n_results(self, query, n):
+    def _page_request(self, query, pagenum):
+        return urllib2.Request(self._TEMPLATE_URL % (urllib.quote_plus(query), pagenum), None, std_headers)
+
+    def _download_n_results(self, query, n, search=None):
         """Downloads a specified number of results for a query"""
 
-        video_ids = []
         already_seen = set()
         pagenum = 1
+        requests = {}
+        window = self._prefetch_window()
 
         while True:
             self.report_download_page(query, pagenum)
-            result_url = self._TEMPLATE_URL % (urllib.quote_plus(query), pagenum)
-            request = urllib2.Request(result_url, None, std_headers)
+            request = requests.pop(pagenum, None)
+            if request is None:
+                request = self._page_request(query, pagenum)
             try:
-                page = urllib2.urlopen(request).read()
+                page = yield request
             except (urllib2.URLError, httplib.HTTPException, socket.error), err:
                 self._downloader.trouble(u'ERROR: unable to download webpage: %s' % str(err))
-                return [None]
+                yield None
+                return
 
             # Extract video identifiers
+            ids_in_page = []
             for mobj in re.finditer(self._VIDEO_INDICATOR, page):
                 video_id = page[mobj.span()[0]:mobj.span()[1]].split('=')[2][:-1]
                 if video_id not in already_seen:
-                    video_ids.append(video_id)
+                    ids_in_page.append(video_id)
                     already_seen.add(video_id)
-                    if len(video_ids) == n:
+                    if len(already_seen) == n:
                         # Specified n videos reached
-                        information = []
-                        for id in video_ids:
-                            information.extend(self._youtube_ie.extract('http://www.youtube.com/watch?v=%s' % id))
-                        return information
-
-            if self._MORE_PAGES_INDICATOR not in page:
-                information = []
-                for id in video_ids:
-                    information.extend(self._youtube_ie.extract('http://www.youtube.com/watch?v=%s' % id))
-                return information
+                        break
+            more_pages = len(already_seen) < n and self._MORE_PAGES_INDICATOR in page
+
+            if more_pages and window > 1:
+                # Fetch the pages expected to be needed next at the same time
+                pages_left = -(-(n - len(already_seen)) * pagenum // max(len(already_seen), 1))
+                prefetch = []
+                for i in xrange(pagenum + 1, pagenum + 1 + min(window, pages_left)):
+                    if i not in requests:
+                        requests[i] = self._page_request(query, i)
+                        prefetch.append(requests[i])
+                yield prefetch
+
+            # Extract the videos of this page before going on with the next one
+            for id in ids_in_page:
+                yield self._youtube_ie.extract_steps('http://www.youtube.com/watch?v=%s' % id, search)
+
+            if not more_pages:
+                break
 
             pagenum = pagenum + 1
 
 class YoutubePlaylistIE(InfoExtractor):
     """Information Extractor for YouTube playlists."""
 
-    _VALID_URL = r'(?:http://)?(?:\w+\.)?youtube.com/view_play_list\?p=(.+)'
+    _VALID_URL = r'(?:http://)?(?:\w+\.)?youtube\.com/view_play_list\?p=(.+)'
+    _URL_HOSTS = ('youtube.com',)
     _TEMPLATE_URL = 'http://www.youtube.com/view_play_list?p=%s&page=%s&gl=US&hl=en'
     _VIDEO_INDICATOR = r'/watch\?v=(.+?)&'
     _MORE_PAGES_INDICATOR = r'/view_play_list?p=%s&amp;page=%s'
@@ -859,44 +2273,62 @@ class YoutubePlaylistIE(InfoExtractor):
 
     def _real_initialize(self):
         self._youtube_ie.initialize()
+
+    def _page_request(self, playlist_id, pagenum):
+        return urllib2.Request(self._TEMPLATE_URL % (playlist_id, pagenum), None, std_headers)
     
-    def _real_extract(self, url):
+    def _extract_steps(self, url):
         # Extract playlist id
         mobj = re.match(self._VALID_URL, url)
         if mobj is None:
             self._downloader.trouble(u'ERROR: invalid url: %s' % url)
-            return [None]
+            yield None
+            return
 
         # Download playlist pages
         playlist_id = mobj.group(1)
-        video_ids = []
         pagenum = 1
+        requests = {}
+        window = self._prefetch_window()
 
         while True:
             self.report_download_page(playlist_id, pagenum)
-            request = urllib2.Request(self._TEMPLATE_URL % (playlist_id, pagenum), None, std_headers)
+            request = requests.pop(pagenum, None)
+            if request is None:
+                request = self._page_request(playlist_id, pagenum)
             try:
-                page = urllib2.urlopen(request).read()
+                page = yield request
             except (urllib2.URLError, httplib.HTTPException, socket.error), err:
                 self._downloader.trouble(u'ERROR: unable to download webpage: %s' % str(err))
-                return [None]
+                yield None
+                return
 
             # Extract video identifiers
             ids_in_page = []
+            seen_in_page = set()
             for mobj in re.finditer(self._VIDEO_INDICATOR, page):
-                if mobj.group(1) not in ids_in_page:
+                if mobj.group(1) not in seen_in_page:
                     ids_in_page.append(mobj.group(1))
-            video_ids.extend(ids_in_page)
-
-            if (self._MORE_PAGES_INDICATOR % (playlist_id, pagenum + 1)) not in page:
+                    seen_in_page.add(mobj.group(1))
+            more_pages = (self._MORE_PAGES_INDICATOR % (playlist_id, pagenum + 1)) in page
+
+            if more_pages and window > 1:
+                # Fetch the following pages at the same time, in case there are more
+                prefetch = []
+                for i in xrange(pagenum + 1, pagenum + 1 + window):
+                    if i not in requests:
+                        requests[i] = self._page_request(playlist_id, i)
+                        prefetch.append(requests[i])
+                yield prefetch
+
+            # Extract the videos of this page before going on with the next one
+            for id in ids_in_page:
+                yield self._youtube_ie.extract_steps('http://www.youtube.com/watch?v=%s' % id, url)
+
+            if not more_pages:
                 break
             pagenum = pagenum + 1
 
-        information = []
-        for id in video_ids:
-            information.extend(self._youtube_ie.extract('http://www.youtube.com/watch?v=%s' % id))
-        return information
-
 class PostProcessor(object):
     """Post Processor class.
 
@@ -912,6 +2344,14 @@ class PostProcessor(object):
 
     PostProcessor objects follow a "mutual registration" process similar
     to InfoExtractor objects.
+
+    PostProcessors may also receive the contents of the file while it is
+    being downloaded, by returning True from stream_start(). The data is
+    then passed to stream_feed() in file order as it is written, and
+    stream_finish() is called once the file is complete, before the chain
+    of run() methods. If the download fails, stream_abort() is called
+    instead, and if it has to restart from the beginning, stream_abort()
+    is followed by a new call to stream_start().
     """
 
     _downloader = None
@@ -942,7 +2382,2338 @@ class PostProcessor(object):
         it was called from.
         """
         return information # by default, do nothing
-    
+
+    def stream_start(self, information):
+        """Prepare to receive the file contents during the download.
+
+        The "information" argument is the same one the first run()
+        method in the chain would receive. Return True to have the
+        contents passed to stream_feed(); by default, they are not.
+        """
+        return False
+
+    def stream_feed(self, data):
+        """Process the next chunk of the file.
+
+        The data may be a string or a memoryview only valid during the
+        call, so it must be copied to be kept. This method may raise a
+        PostProcessingError exception to stop the download.
+        """
+        pass
+
+    def stream_finish(self):
+        """The whole file has been fed. May raise PostProcessingError."""
+        pass
+
+    def stream_abort(self):
+        """The download failed or is restarting; discard the fed data."""
+        pass
+
+class URLDispatcher(object):
+    """Index finding the first suitable InfoExtractor for a URL.
+
+    The InfoExtractors defining _URL_HOSTS are indexed by host name, and
+    the regular expressions of the candidates for a host are joined in a
+    single one, with a named group for each of them. The others are asked
+    through their suitable() method, keeping the order in which all of
+    them were registered.
+    """
+
+    _HOST_RE = re.compile(r'(?:[A-Za-z][A-Za-z0-9+.-]*://)?([\w-]+(?:\.[\w-]+)+)(?:[:/?#]|$)')
+    _MAX_CACHED_HOSTS = 1000
+
+    _ies = None
+    _by_host = None
+    _unindexed = None
+    _plans = None
+    _host_plans = None
+
+    def __init__(self, ies):
+        self._ies = list(ies)
+        self._by_host = {}
+        self._unindexed = []
+        self._plans = {}
+        self._host_plans = {}
+        for position, ie in enumerate(self._ies):
+            if ie._URL_HOSTS is None or ie._VALID_URL is None:
+                self._unindexed.append(position)
+                continue
+            for host in ie._URL_HOSTS:
+                self._by_host.setdefault(host, []).append(position)
+
+    @classmethod
+    def url_host(cls, url):
+        """Returns the lowercase host name of url, or '' if it has none."""
+        mobj = cls._HOST_RE.match(url)
+        if mobj is None:
+            return ''
+        return mobj.group(1).lower()
+
+    def _candidates(self, host):
+        """Return the positions of the InfoExtractors to try for host."""
+        positions = set(self._unindexed)
+        positions.update(self._by_host.get('', []))
+        while host != '':
+            positions.update(self._by_host.get(host, []))
+            host = host.partition('.')[2]
+        return tuple(sorted(positions))
+
+    def _build_plan(self, positions):
+        """Return the steps testing the InfoExtractors at positions in order.
+
+        Each step is a (regexp, groups) pair, where groups maps the names
+        of the groups in regexp to InfoExtractors, or a (None, ie) pair for
+        the InfoExtractors having to be asked through suitable().
+        """
+        plan = []
+        alternatives = []
+        groups = {}
+        for position in positions:
+            ie = self._ies[position]
+            if ie._URL_HOSTS is None or ie._VALID_URL is None:
+                if len(alternatives) > 0:
+                    plan.append((re.compile('|'.join(alternatives)), groups))
+                    alternatives = []
+                    groups = {}
+                plan.append((None, ie))
+                continue
+            name = 'ie_%d' % position
+            alternatives.append('(?P<%s>%s)' % (name, ie._VALID_URL))
+            groups[name] = ie
+        if len(alternatives) > 0:
+            plan.append((re.compile('|'.join(alternatives)), groups))
+        return plan
+
+    def _plan(self, host):
+        """Return the dispatch plan for URLs of host."""
+        plan = self._host_plans.get(host, None)
+        if plan is not None:
+            return plan
+        positions = self._candidates(host)
+        plan = self._plans.get(positions, None)
+        if plan is None:
+            plan = self._build_plan(positions)
+            self._plans[positions] = plan
+        if len(self._host_plans) >= self._MAX_CACHED_HOSTS:
+            self._host_plans = {}
+        self._host_plans[host] = plan
+        return plan
+
+    def find(self, url):
+        """Return the first InfoExtractor suitable for url, or None."""
+        for regexp, target in self._plan(self.url_host(url)):
+            if regexp is None:
+                if target.suitable(url):
+                    return target
+                continue
+            mobj = regexp.match(url)
+            if mobj is not None:
+                return target[mobj.lastgroup]
+        return None
+
+class PostProcessingStream(object):
+    """Output file feeding the written data to streaming PostProcessors.
+
+    It wraps the file a download is written to. Data written at the end of
+    the file is passed on to the PostProcessors that accepted it in their
+    stream_start() method. If the file is written out of order, as in
+    segmented downloads, feeding stops, and the whole file is read back
+    from disk and fed once it is complete.
+    """
+
+    _REPLAY_BLOCK_SIZE = 1048576
+
+    _stream = None
+    _filename = None
+    _pps = None
+    _information = None
+    _consumers = None
+    _in_order = True
+
+    def __init__(self, stream, filename, pps, information):
+        self._stream = stream
+        self._filename = filename
+        self._pps = pps
+        self._information = information
+        self._consumers = []
+        self._in_order = True
+
+    def start(self, resume_len=0):
+        """Start the streaming PostProcessors, feeding them resume_len bytes."""
+        self._consumers = [pp for pp in self._pps if pp.stream_start(self._information)]
+        self._in_order = True
+        if resume_len > 0:
+            self._replay(resume_len)
+
+    def _replay(self, length=None):
+        """Feed the first length bytes of the file on disk (all if None)."""
+        if len(self._consumers) == 0:
+            return
+        infile = open(self._filename, 'rb')
+        try:
+            while length is None or length > 0:
+                block_size = self._REPLAY_BLOCK_SIZE
+                if length is not None:
+                    block_size = min(block_size, length)
+                    length -= block_size
+                data = infile.read(block_size)
+                if len(data) == 0:
+                    break
+                for pp in self._consumers:
+                    pp.stream_feed(data)
+        finally:
+            infile.close()
+
+    def write(self, data):
+        self._stream.write(data)
+        if self._in_order:
+            for pp in self._consumers:
+                pp.stream_feed(data)
+
+    def seek(self, offset, whence=0):
+        self._in_order = False
+        self._stream.seek(offset, whence)
+
+    def truncate(self, size):
+        self._stream.truncate(size)
+        self._in_order = False
+
+    def restart(self):
+        """Discard the data written so far, to download the file again.
+
+        The file is opened again for writing, as a file opened to append
+        to a partial download writes at its end whatever the position.
+        """
+        self._stream.close()
+        self._stream = open(self._filename, 'wb')
+        self._in_order = True
+        if len(self._consumers) > 0:
+            self.abort()
+            self.start()
+
+    def close(self):
+        self._stream.close()
+
+    def finish(self):
+        """Called after closing the complete file."""
+        if not self._in_order:
+            self._replay()
+        for pp in self._consumers:
+            pp.stream_finish()
+
+    def abort(self):
+        """Called when the download fails."""
+        for pp in self._consumers:
+            pp.stream_abort()
+        self._consumers = []
+
+class EventLoop(object):
+    """Minimal select() based event loop.
+
+    Callbacks are run when a socket becomes readable or writable, or when
+    a timer expires. run() returns once there is nothing left to wait
+    for. An exception raised by a callback stops the loop and is raised
+    again by run().
+    """
+
+    _readers = None
+    _writers = None
+    _timers = None
+    _live_timers = 0
+    _timer_count = 0
+
+    def __init__(self):
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._live_timers = 0
+        self._timer_count = 0
+
+    def add_reader(self, sock, callback):
+        self._readers[sock.fileno()] = callback
+
+    def remove_reader(self, sock):
+        self._readers.pop(sock.fileno(), None)
+
+    def add_writer(self, sock, callback):
+        self._writers[sock.fileno()] = callback
+
+    def remove_writer(self, sock):
+        self._writers.pop(sock.fileno(), None)
+
+    def call_later(self, delay, callback):
+        """Run callback after delay seconds. Returns a handle for cancel()."""
+        self._timer_count += 1
+        timer = [time.time() + delay, self._timer_count, callback]
+        heapq.heappush(self._timers, timer)
+        self._live_timers += 1
+        return timer
+
+    def cancel(self, timer):
+        """Cancel a timer returned by call_later()."""
+        if timer[2] is not None:
+            timer[2] = None
+            self._live_timers -= 1
+
+    def run(self):
+        """Run callbacks until there is nothing left to wait for."""
+        while len(self._readers) > 0 or len(self._writers) > 0 or self._live_timers > 0:
+            while len(self._timers) > 0 and self._timers[0][2] is None:
+                heapq.heappop(self._timers)
+            timeout = None
+            if len(self._timers) > 0:
+                timeout = max(self._timers[0][0] - time.time(), 0.0)
+            if len(self._readers) > 0 or len(self._writers) > 0:
+                try:
+                    readable, writable, failed = select.select(self._readers.keys(), self._writers.keys(), [], timeout)
+                except select.error, err:
+                    if err[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd in writable:
+                    callback = self._writers.get(fd, None)
+                    if callback is not None:
+                        callback()
+                for fd in readable:
+                    callback = self._readers.get(fd, None)
+                    if callback is not None:
+                        callback()
+            elif timeout > 0:
+                time.sleep(timeout)
+            now = time.time()
+            while len(self._timers) > 0 and self._timers[0][0] <= now:
+                timer = heapq.heappop(self._timers)
+                callback = timer[2]
+                if callback is not None:
+                    timer[2] = None
+                    self._live_timers -= 1
+                    callback()
+
+class AsyncHTTPFetch(object):
+    """Non-blocking HTTP request run by an EventLoop.
+
+    The urllib2.Request is sent through the given HTTP proxy, if any, with
+    "Connection: close", and redirections are followed. The response is
+    passed to the callbacks: on_headers(status, reason, headers) when the
+    headers of the final response arrive, with headers being an
+    httplib.HTTPMessage, on_data(data) for every block of the body, and
+    on_done(error) at the end, where error is None or the sys.exc_info()
+    of the failure. The callbacks can call close() to drop the request
+    without further calls, and reading can be paused to apply rate limits.
+    Exceptions raised by the callbacks are not caught, and stop the event
+    loop. Cookies are sent from and stored in cookie_jar, if given.
+    """
+
+    _MAX_REDIRECTIONS = 10
+    _MAX_HEADER_SIZE = 65536
+    _NO_BODY_STATUSES = (204, 304)
+    _REDIRECT_STATUSES = (301, 302, 303, 307)
+
+    _dns_cache = {}
+
+    read_size = 65536
+
+    _loop = None
+    _proxy = None
+    _cookie_jar = None
+    _on_headers = None
+    _on_data = None
+    _on_done = None
+    _request = None
+    _redirections = 0
+    _sock = None
+    _outgoing = None
+    _buffer = None
+    _headers_done = False
+    _body_left = None
+    _chunked = False
+    _chunk_left = None
+    _paused = False
+    _closed = False
+    _timeout = None
+    _timer = None
+    _last_activity = None
+
+    def __init__(self, loop, request, proxy, on_headers, on_data, on_done, cookie_jar=None):
+        self._loop = loop
+        self._proxy = proxy
+        self._cookie_jar = cookie_jar
+        self._on_headers = on_headers
+        self._on_data = on_data
+        self._on_done = on_done
+        self._redirections = 0
+        self._timeout = socket.getdefaulttimeout()
+        self._start(request)
+
+    @classmethod
+    def _resolve(cls, host, port):
+        """Returns the first address of host, caching the results."""
+        key = (host, port)
+        addresses = cls._dns_cache.get(key, None)
+        if addresses is None:
+            addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            cls._dns_cache[key] = addresses
+        return addresses[0]
+
+    def _start(self, request):
+        """Connect and send request, failing asynchronously on errors."""
+        self._request = request
+        self._buffer = ''
+        self._headers_done = False
+        self._body_left = None
+        self._chunked = False
+        self._chunk_left = None
+        try:
+            url = request.get_full_url()
+            scheme, rest = urllib.splittype(url)
+            if scheme is None or scheme.lower() != 'http':
+                raise urllib2.URLError('unsupported URL scheme: %s' % url)
+            host, selector = urllib.splithost(rest)
+            if selector == '':
+                selector = '/'
+            target = host
+            if self._proxy is not None:
+                target = urllib.splithost(urllib.splittype(self._proxy)[1])[0]
+                selector = url
+            target_host, target_port = urllib.splitport(target)
+            family, socktype, proto, canonname, address = self._resolve(target_host, int(target_port or 80))
+            if self._cookie_jar is not None:
+                self._cookie_jar.add_cookie_header(request)
+
+            lines = ['%s %s HTTP/1.1' % (request.get_method(), selector), 'Host: %s' % host]
+            for name, value in request.header_items():
+                if name.lower() not in ('host', 'connection'):
+                    lines.append('%s: %s' % (name, value))
+            data = request.get_data()
+            if data is not None:
+                if not request.has_header('Content-type'):
+                    lines.append('Content-type: application/x-www-form-urlencoded')
+                lines.append('Content-length: %d' % len(data))
+            lines.append('Connection: close')
+            self._outgoing = '\r\n'.join(lines) + '\r\n\r\n' + (data or '')
+
+            self._sock = socket.socket(family, socktype, proto)
+            self._sock.setblocking(0)
+            err = self._sock.connect_ex(address)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise socket.error(err, os.strerror(err))
+        except Exception:
+            error = sys.exc_info()
+            self._loop.call_later(0, lambda: self._finish(error))
+            return
+        self._last_activity = time.time()
+        self._loop.add_writer(self._sock, self._on_writable)
+        if self._timeout is not None:
+            self._timer = self._loop.call_later(self._timeout, self._check_timeout)
+
+    def _check_timeout(self):
+        idle = time.time() - self._last_activity
+        if self._paused or idle < self._timeout:
+            self._timer = self._loop.call_later(self._timeout - [idle, 0][self._paused], self._check_timeout)
+            return
+        self._timer = None
+        try:
+            raise socket.timeout('timed out')
+        except socket.timeout:
+            self._finish(sys.exc_info())
+
+    def _close_socket(self):
+        if self._sock is not None:
+            self._loop.remove_reader(self._sock)
+            self._loop.remove_writer(self._sock)
+            self._sock.close()
+            self._sock = None
+        if self._timer is not None:
+            self._loop.cancel(self._timer)
+            self._timer = None
+
+    def close(self):
+        """Drop the request without calling any more callbacks."""
+        self._closed = True
+        self._close_socket()
+
+    def pause(self):
+        """Stop reading the response until resume() is called."""
+        self._paused = True
+        if self._sock is not None:
+            self._loop.remove_reader(self._sock)
+
+    def resume(self):
+        """Go on reading the response after pause()."""
+        self._paused = False
+        self._last_activity = time.time()
+        if self._sock is not None and self._outgoing == '':
+            self._loop.add_reader(self._sock, self._on_readable)
+
+    def _finish(self, error=None):
+        if self._closed:
+            return
+        self._closed = True
+        self._close_socket()
+        self._on_done(error)
+
+    def _on_writable(self):
+        try:
+            err = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                raise socket.error(err, os.strerror(err))
+            sent = self._sock.send(self._outgoing)
+        except socket.error, err:
+            if err[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._finish(sys.exc_info())
+            return
+        self._last_activity = time.time()
+        self._outgoing = self._outgoing[sent:]
+        if self._outgoing == '':
+            self._loop.remove_writer(self._sock)
+            if not self._paused:
+                self._loop.add_reader(self._sock, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            data = self._sock.recv(self.read_size)
+        except socket.error, err:
+            if err[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._finish(sys.exc_info())
+            return
+        self._last_activity = time.time()
+        # Only protocol errors are caught while parsing the response, so
+        # the exceptions raised by the callbacks reach the event loop
+        if not self._headers_done:
+            self._receive_headers(data)
+        else:
+            self._receive_body(data)
+
+    def _incomplete_read(self):
+        """Fail because the connection closed before the end of the body."""
+        try:
+            raise httplib.IncompleteRead('')
+        except httplib.IncompleteRead:
+            self._finish(sys.exc_info())
+
+    def _parse_headers(self, data):
+        """Add data to the buffer and parse the final response headers.
+
+        Returns (status, reason, headers), with headers being an
+        httplib.HTTPMessage, or None if they have not arrived yet. Raises
+        httplib.HTTPException or ValueError if they are malformed.
+        """
+        self._buffer += data
+        while True:
+            end = self._buffer.find('\r\n\r\n')
+            if end < 0:
+                if data == '':
+                    raise httplib.BadStatusLine(self._buffer)
+                if len(self._buffer) > self._MAX_HEADER_SIZE:
+                    raise httplib.HTTPException('response headers too long')
+                return None
+            status_line, sep, header_text = self._buffer[:end].partition('\r\n')
+            self._buffer = self._buffer[end + 4:]
+            parts = status_line.split(None, 2)
+            if len(parts) < 2 or not parts[0].startswith('HTTP/') or not parts[1].isdigit():
+                raise httplib.BadStatusLine(status_line)
+            status = int(parts[1])
+            if status >= 200:
+                break
+            # Skip "100 Continue" and other informational responses
+        reason = ''
+        if len(parts) > 2:
+            reason = parts[2]
+        headers = httplib.HTTPMessage(cStringIO.StringIO(header_text + '\r\n\r\n'))
+        if headers.get('Content-length', None) is not None:
+            long(headers['Content-length'])
+        if status in self._REDIRECT_STATUSES and headers.get('Location', None) is not None:
+            if self._redirections >= self._MAX_REDIRECTIONS:
+                raise httplib.HTTPException('too many redirections')
+        return (status, reason, headers)
+
+    def _receive_headers(self, data):
+        try:
+            response = self._parse_headers(data)
+        except (httplib.HTTPException, ValueError):
+            self._finish(sys.exc_info())
+            return
+        if response is None:
+            return
+        status, reason, headers = response
+        if self._cookie_jar is not None:
+            self._cookie_jar.extract_cookies(urllib.addinfourl(cStringIO.StringIO(), headers, self._request.get_full_url()), self._request)
+
+        location = headers.get('Location', None)
+        if status in self._REDIRECT_STATUSES and location is not None:
+            self._redirections += 1
+            self._close_socket()
+            new_request = urllib2.Request(urlparse.urljoin(self._request.get_full_url(), location), None,
+                    dict([(name, value) for name, value in self._request.header_items()
+                        if name.lower() not in ('content-length', 'content-type')]))
+            self._start(new_request)
+            return
+
+        self._headers_done = True
+        if self._request.get_method() == 'HEAD' or status in self._NO_BODY_STATUSES:
+            self._body_left = 0
+        elif headers.get('Transfer-encoding', '').lower() == 'chunked':
+            self._chunked = True
+        elif headers.get('Content-length', None) is not None:
+            self._body_left = long(headers['Content-length'])
+        self._on_headers(status, reason, headers)
+        if self._closed:
+            return
+        data = self._buffer
+        self._buffer = ''
+        if data != '' or self._body_left == 0:
+            self._receive_body(data, False)
+
+    def _receive_body(self, data, from_socket=True):
+        if self._chunked:
+            self._receive_chunks(data, from_socket)
+        elif self._body_left is None:
+            if data == '':
+                self._finish()
+            else:
+                self._on_data(data)
+        else:
+            if data == '' and from_socket and self._body_left > 0:
+                self._incomplete_read()
+                return
+            if data != '':
+                data = data[:self._body_left]
+                self._body_left -= len(data)
+                self._on_data(data)
+            if self._body_left == 0:
+                self._finish()
+
+    def _receive_chunks(self, data, from_socket):
+        if data == '' and from_socket:
+            self._incomplete_read()
+            return
+        self._buffer += data
+        while not self._closed:
+            if self._chunk_left is None:
+                end = self._buffer.find('\r\n')
+                if end < 0:
+                    return
+                try:
+                    size = int(self._buffer[:end].split(';', 1)[0], 16)
+                except ValueError:
+                    self._finish(sys.exc_info())
+                    return
+                self._buffer = self._buffer[end + 2:]
+                if size == 0:
+                    # Trailers, if any, are ignored
+                    self._finish()
+                    return
+                self._chunk_left = size
+            elif self._chunk_left == 0:
+                if len(self._buffer) < 2:
+                    return
+                self._buffer = self._buffer[2:]
+                self._chunk_left = None
+            else:
+                if self._buffer == '':
+                    return
+                piece = self._buffer[:self._chunk_left]
+                self._buffer = self._buffer[len(piece):]
+                self._chunk_left -= len(piece)
+                self._on_data(piece)
+
+class EventLoopEngine(object):
+    """Download engine running every transfer in a single thread.
+
+    It is used instead of threads when the "eventloop" option is set. The
+    extraction steps of many URLs (see InfoExtractor) advance at the same
+    time, with their webpages fetched by non-blocking requests, and up to
+    "concurrent" files are downloaded at the same time, all of them in
+    the calling thread. The videos of a URL like a playlist or a search
+    are extracted separately too, up to _MAX_EXTRACTIONS of them at a
+    time besides the URLs themselves, and queued for download in their
+    order in the playlist. InfoExtractor initialization, postprocessing and
+    the extractors not defining _extract_steps() still block the loop, and
+    files are always downloaded through a single connection.
+    """
+
+    _MAX_EXTRACTIONS = 256
+    _MAX_PENDING = 256
+
+    _downloader = None
+    _loop = None
+    _proxy = None
+    _urls = None
+    _extractions = 0
+    _nested = 0
+    _waiting = None
+    _pending = None
+    _transfers = None
+    _max_transfers = 1
+    _fetches = None
+    _scheduling = False
+    _schedule_again = False
+
+    def __init__(self, downloader):
+        self._downloader = downloader
+        self._loop = EventLoop()
+        self._proxy = downloader.params.get('proxy', None)
+        if self._proxy is None:
+            self._proxy = urllib.getproxies().get('http', None)
+        self._extractions = 0
+        self._nested = 0
+        self._waiting = collections.deque()
+        self._pending = collections.deque()
+        self._transfers = set()
+        self._max_transfers = downloader.params.get('concurrent', 1)
+        self._fetches = set()
+
+    def run(self, url_list):
+        """Process every URL in url_list, an iterable of (URL, InfoExtractor)
+        pairs like the one returned by FileDownloader._unique_urls()."""
+        self._urls = iter(url_list)
+        try:
+            self._schedule()
+            self._loop.run()
+        finally:
+            for fetch in list(self._fetches):
+                fetch.close()
+            for transfer in list(self._transfers):
+                transfer.abort()
+
+    def open(self, request, on_headers, on_data, on_done):
+        """Start a request (see AsyncHTTPFetch), returning the fetch."""
+        fetch = None
+        def done(error):
+            self._fetches.discard(fetch)
+            on_done(error)
+        fetch = AsyncHTTPFetch(self._loop, request, self._proxy, on_headers, on_data, done, self._downloader.cookie_jar())
+        self._fetches.add(fetch)
+        return fetch
+
+    def close(self, fetch):
+        """Drop a request started with open()."""
+        self._fetches.discard(fetch)
+        fetch.close()
+
+    def fetch_page(self, request, callback):
+        """Fetch a webpage, calling callback(page, error) with the result.
+
+        Returns the fetch, to be dropped with close(), or None if the page
+        was in the cache.
+        """
+        downloader = self._downloader
+        start = time.time()
+        page = downloader.cached_page(request)
+        if page is not None:
+            downloader.trace_span('fetch', request.get_full_url(), start, 'cached', bytes=len(page))
+            self._loop.call_later(0, lambda: callback(page, None))
+            return
+        chunks = []
+        response = []
+        fetch = []
+        def on_headers(status, reason, headers):
+            response.extend([status, reason, headers])
+        def on_data(data):
+            chunks.append(data)
+            if isinstance(request, PageRequest) and response[0] < 400 and '\n' in data:
+                page = request.truncate(''.join(chunks))
+                if page is not None:
+                    self.close(fetch[0])
+                    downloader.trace_span('fetch', request.get_full_url(), start, 'truncated', bytes=len(page))
+                    callback(page, None)
+        def on_done(error):
+            if error is None and response[0] >= 400:
+                try:
+                    raise urllib2.HTTPError(request.get_full_url(), response[0], response[1], response[2], None)
+                except urllib2.HTTPError:
+                    error = sys.exc_info()
+            if error is not None:
+                downloader.trace_span('fetch', request.get_full_url(), start, 'error')
+                callback(None, error)
+                return
+            page = ''.join(chunks)
+            downloader.trace_span('fetch', request.get_full_url(), start, bytes=len(page))
+            downloader.cache_page(request, page)
+            callback(page, None)
+        fetch.append(self.open(request, on_headers, on_data, on_done))
+        return fetch[0]
+
+    def _prefetch_page(self, request):
+        """Start fetching a webpage. Returns a (fetch, wait) pair, where fetch
+        is as returned by fetch_page() and wait is a function taking the
+        callback to call with the result, as in fetch_page()."""
+        result = []
+        waiters = []
+        def done(page, error):
+            if len(waiters) > 0:
+                waiters[0](page, error)
+            else:
+                result.append((page, error))
+        fetch = self.fetch_page(request, done)
+        def wait(callback):
+            if len(result) > 0:
+                self._loop.call_later(0, lambda: callback(*result[0]))
+            else:
+                waiters.append(callback)
+        return (fetch, wait)
+
+    def call_later(self, delay, callback):
+        return self._loop.call_later(delay, callback)
+
+    def _schedule(self):
+        """Start transfers and extractions while there is room for them."""
+        if self._scheduling:
+            self._schedule_again = True
+            return
+        self._scheduling = True
+        try:
+            self._schedule_again = True
+            while self._schedule_again:
+                self._schedule_again = False
+                while len(self._transfers) < self._max_transfers and len(self._pending) > 0:
+                    transfer = EventLoopTransfer(self, self._pending.popleft())
+                    if transfer.start():
+                        self._transfers.add(transfer)
+                while len(self._waiting) > 0 and self._nested_room():
+                    steps, results, resume = self._waiting.popleft()
+                    self._start_nested(steps, results)
+                    resume()
+                while (self._urls is not None and self._extractions < self._MAX_EXTRACTIONS
+                        and len(self._pending) < self._MAX_PENDING):
+                    try:
+                        url, ie = self._urls.next()
+                    except StopIteration:
+                        self._urls = None
+                        break
+                    if ie is None:
+                        self._downloader.trouble('ERROR: no suitable InfoExtractor: %s' % url)
+                        continue
+                    self._extractions += 1
+                    self._advance_extraction(ie.extract_steps(url, flatten=False), _ExtractionResults(), {}, None, None)
+        finally:
+            self._scheduling = False
+
+    def _nested_room(self):
+        """Checks if another nested extraction can be started."""
+        return self._nested < self._MAX_EXTRACTIONS and len(self._pending) < self._MAX_PENDING
+
+    def _start_nested(self, steps, results):
+        """Start a nested extraction, whose results go to results."""
+        self._nested += 1
+        self._advance_extraction(steps, results, {}, None, None)
+
+    def _advance_extraction(self, steps, results, prefetched, reply, error):
+        """Run the steps of an extraction until it needs a webpage.
+
+        results is the _ExtractionResults of the extraction. Nested steps
+        yielded by a URL are started as extractions of their own, waiting
+        until there is room for them (see _nested_room()), and their
+        results are added to the URL results in place of the steps.
+
+        prefetched maps the requests fetched in the background to the
+        pairs returned by _prefetch_page(). The ones still there when the
+        extraction finishes are no longer needed and are dropped.
+        """
+        while True:
+            try:
+                step = InfoExtractor.resume_steps(steps, reply, error)
+            except StopIteration:
+                for fetch, wait in prefetched.values():
+                    if fetch is not None:
+                        self.close(fetch)
+                results.finished = True
+                if results.top is results:
+                    self._extractions -= 1
+                self._release_results(results.top)
+                return
+            reply = None
+            error = None
+            if isinstance(step, types.GeneratorType):
+                nested = _ExtractionResults(results.top)
+                results.top.entries.append(nested)
+                if self._nested_room():
+                    self._start_nested(step, nested)
+                    continue
+                resume = lambda: self._advance_extraction(steps, results, prefetched, None, None)
+                self._waiting.append((step, nested, resume))
+                return
+            if isinstance(step, list):
+                for request in step:
+                    if request not in prefetched:
+                        prefetched[request] = self._prefetch_page(request)
+                continue
+            if isinstance(step, urllib2.Request):
+                callback = lambda page, error: self._advance_extraction(steps, results, prefetched, page, error)
+                prefetch = prefetched.pop(step, None)
+                if prefetch is None:
+                    self.fetch_page(step, callback)
+                else:
+                    prefetch[1](callback)
+                return
+            if step is None:
+                self._downloader.trouble()
+                continue
+            results.top.num_results += 1
+            if results.top.num_results > 1 and self._downloader.fixed_template():
+                raise SameFileError(self._downloader.params['outtmpl'])
+            results.entries.append(step)
+            self._release_results(results.top)
+
+    def _release_results(self, top):
+        """Queue for download the results of the extraction of a URL that
+        are not behind a nested extraction still running.
+
+        A nested extraction counts as running until all of its results
+        are queued, so the results waiting for the ones before them are
+        bounded too.
+        """
+        entries = top.entries
+        while len(entries) > 0:
+            entry = entries[0]
+            if isinstance(entry, _ExtractionResults):
+                self._pending.extend(entry.entries)
+                entry.entries.clear()
+                if not entry.finished:
+                    break
+                self._nested -= 1
+            else:
+                self._pending.append(entry)
+            entries.popleft()
+        self._schedule()
+
+    def transfer_done(self, transfer):
+        """Called by a transfer when it finishes, successfully or not."""
+        self._transfers.discard(transfer)
+        self._loop.call_later(0, self._schedule)
+
+class _ExtractionResults(object):
+    """Results of an extraction run by an EventLoopEngine, in order.
+
+    The entries of the extraction of a URL are its results and the
+    _ExtractionResults of its nested extractions, standing for theirs.
+    top is the _ExtractionResults of the URL, which counts its results.
+    """
+
+    top = None
+    entries = None
+    finished = False
+    num_results = 0
+
+    def __init__(self, top=None):
+        self.top = [top, self][top is None]
+        self.entries = collections.deque()
+        self.finished = False
+        self.num_results = 0
+
+class EventLoopTransfer(object):
+    """Download of a video file run by an EventLoopEngine.
+
+    It follows the same steps as FileDownloader.process_info(), resuming
+    partial downloads when the server allows it.
+    """
+
+    _engine = None
+    _downloader = None
+    _info_dict = None
+    _url = None
+    _host = None
+    _filename = None
+    _tmpfilename = None
+    _stream = None
+    _resume_len = 0
+    _fetch = None
+    _mode = None
+    _data_len = None
+    _total_len = None
+    _byte_counter = 0
+    _start_time = None
+    _download_start = None
+
+    def __init__(self, engine, info_dict):
+        self._engine = engine
+        self._downloader = engine._downloader
+        self._info_dict = info_dict
+        self._url = info_dict['url']
+        self._host = FileDownloader.url_host(self._url)
+
+    def start(self):
+        """Start the download. Returns False if there is nothing to download."""
+        download = self._downloader._prepare_download(self._info_dict)
+        if download is None:
+            return False
+        self._filename, self._tmpfilename, self._stream, self._resume_len = download
+        self._download_start = self._downloader._download_started(self._filename, self._resume_len)
+        try:
+            self._stream.start(self._resume_len)
+        except (OSError, IOError), err:
+            self._fail('ERROR: unable to write video data: %s' % str(err), False)
+            return False
+        except (PostProcessingError), err:
+            self._fail('ERROR: postprocessing: %s' % str(err), False)
+            return False
+        if self._resume_len > 0:
+            self._downloader.report_resuming_byte(self._resume_len)
+            self._request('resume')
+        else:
+            self._request('full')
+        return True
+
+    def _request(self, mode):
+        """Request the file. The mode tells how to handle the response:
+
+        'resume' asks for the bytes after the partial download, 'check'
+        asks for the whole file after the server refused to resume, to see
+        if it had already been downloaded, and 'full' asks for the whole
+        file.
+        """
+        self._mode = mode
+        request = urllib2.Request(self._url, None, std_headers)
+        if mode == 'resume':
+            request.add_header('Range', 'bytes=%d-' % self._resume_len)
+        self._fetch = self._engine.open(request, self._on_headers, self._on_data, self._on_done)
+        self._fetch.read_size = self._downloader.limit_block_size(self._host, AsyncHTTPFetch.read_size)
+
+    def _restart(self, mode):
+        """Drop the current response and request the file again."""
+        self._engine.close(self._fetch)
+        self._request(mode)
+
+    def _on_headers(self, status, reason, headers):
+        if self._mode == 'resume' and status == 416:
+            self._restart('check')
+            return
+        if status >= 400:
+            self._fail('ERROR: unable to download video data: HTTP Error %d: %s' % (status, reason))
+            return
+        try:
+            if self._mode == 'check':
+                if headers.get('Content-length', None) == str(self._resume_len):
+                    # The file had already been fully downloaded
+                    self._engine.close(self._fetch)
+                    self._downloader.report_file_already_downloaded(self._filename)
+                    self._complete()
+                    return
+                self._downloader.report_unable_to_resume()
+                self._resume_len = 0
+                self._stream.restart()
+            elif self._mode == 'resume':
+                mobj = re.match(r'bytes (\d+)-', headers.get('Content-range', ''))
+                if mobj is None or long(mobj.group(1)) != self._resume_len:
+                    self._downloader.report_unable_to_resume()
+                    self._resume_len = 0
+                    self._stream.restart()
+                    if mobj is not None:
+                        self._restart('full')
+                        return
+        except (OSError, IOError), err:
+            self._fail('ERROR: unable to write video data: %s' % str(err))
+            return
+        except (PostProcessingError), err:
+            self._fail('ERROR: postprocessing: %s' % str(err))
+            return
+        self._data_len = headers.get('Content-length', None)
+        self._total_len = None
+        if self._data_len is not None:
+            self._data_len = long(self._data_len)
+            self._total_len = self._data_len + self._resume_len
+        self._byte_counter = 0
+        self._start_time = time.time()
+        if self._downloader._progress_hooks:
+            self._downloader._emit_progress('downloading', self._filename, self._resume_len, self._total_len, 0.0, 0)
+
+    def _on_data(self, data):
+        try:
+            self._stream.write(data)
+        except (OSError, IOError), err:
+            self._fail('ERROR: unable to write video data: %s' % str(err))
+            return
+        except (PostProcessingError), err:
+            self._fail('ERROR: postprocessing: %s' % str(err))
+            return
+        self._byte_counter += len(data)
+        if self._downloader._progress_hooks:
+            self._downloader._emit_progress('downloading', self._filename, self._byte_counter + self._resume_len,
+                    self._total_len, time.time() - self._start_time, self._byte_counter)
+        delay = self._downloader.rate_limit_delay(self._host, len(data))
+        if delay > 0:
+            self._fetch.pause()
+            self._engine.call_later(delay, self._fetch.resume)
+
+    def _on_done(self, error):
+        if error is not None:
+            self._fail('ERROR: unable to download video data: %s' % str(error[1]))
+            return
+        if self._downloader._progress_hooks:
+            self._downloader._emit_progress('finished', self._filename, self._byte_counter + self._resume_len,
+                    self._total_len, time.time() - self._start_time, self._byte_counter)
+        if self._data_len is not None and self._byte_counter != self._data_len:
+            self._fail('ERROR: unable to download video data: Content too short: %s/%s bytes' %
+                    (self._byte_counter + self._resume_len, self._total_len))
+            return
+        self._complete()
+
+    def _complete(self):
+        try:
+            self._stream.close()
+            self._stream.finish()
+        except (OSError, IOError), err:
+            self._fail('ERROR: unable to write video data: %s' % str(err))
+            return
+        except (PostProcessingError), err:
+            self._fail('ERROR: postprocessing: %s' % str(err))
+            return
+        self._downloader._download_finished(self._info_dict, self._filename, self._tmpfilename, self._download_start, 'ok')
+        self._engine.transfer_done(self)
+        try:
+            self._downloader._complete_download(self._info_dict, self._filename, self._tmpfilename)
+        finally:
+            self._downloader._release_filename(self._filename)
+
+    def abort(self):
+        """Stop the download, keeping the partial file."""
+        if self._fetch is not None:
+            self._engine.close(self._fetch)
+        self._stream.close()
+        self._stream.abort()
+        self._downloader._release_filename(self._filename)
+
+    def _fail(self, message, started=True):
+        self.abort()
+        self._downloader._download_finished(self._info_dict, self._filename, self._tmpfilename, self._download_start, 'error')
+        if started:
+            self._engine.transfer_done(self)
+        self._downloader.trouble(message)
+
+class ProgressRenderer(object):
+    """Progress hook printing the download progress on the terminal.
+
+    It is added to every FileDownloader not in quiet mode. To keep the
+    cost of fast downloads with small blocks low, the progress of each
+    transfer is formatted and printed at most once every _INTERVAL
+    seconds, besides the final update.
+    """
+
+    _INTERVAL = 0.25
+
+    _downloader = None
+    _last_render = None
+
+    def __init__(self, downloader):
+        self._downloader = downloader
+        self._last_render = {}
+
+    def __call__(self, event):
+        filename = event['filename']
+        now = time.time()
+        finished = (event['status'] == 'finished')
+        if not finished and now - self._last_render.get(filename, 0.0) < self._INTERVAL:
+            return
+        self._last_render[filename] = now
+
+        percent_str = FileDownloader.calc_percent(event['downloaded_bytes'], event['total_bytes'])
+        data_len_str = FileDownloader.format_bytes(event['total_bytes'])
+        speed_str = FileDownloader.format_speed(event['speed'])
+        eta_str = FileDownloader.format_eta(event['eta'])
+        self._downloader.report_progress(percent_str, data_len_str, speed_str, eta_str, filename)
+        if finished:
+            del self._last_render[filename]
+            self._downloader.report_finish(filename)
+
+class ReceiveBuffer(object):
+    """Reads blocks from a response into a reusable buffer.
+
+    When the response supports readinto(), blocks are received into a
+    single bytearray, grown as needed up to the largest block size used,
+    and returned as memoryview slices of it. This way a transfer does not
+    allocate a new string for every block, and its memory use does not
+    depend on the length of the file. Each block is only valid until the
+    next call to read(). Other responses are read with their read()
+    method.
+    """
+
+    _readinto = None
+    _read = None
+    _buffer = None
+    _view = None
+
+    def __init__(self, response):
+        self._readinto = getattr(response, 'readinto', None)
+        self._read = response.read
+        self._buffer = None
+        self._view = None
+
+    def read(self, size):
+        """Returns a block of at most size bytes, empty at the end of the data."""
+        if self._readinto is None:
+            return self._read(size)
+        if self._buffer is None or len(self._buffer) < size:
+            capacity = size
+            if self._buffer is not None:
+                capacity = min(max(size, 2 * len(self._buffer)), 4194304)
+            self._buffer = bytearray(max(capacity, size))
+            self._view = memoryview(self._buffer)
+        count = self._readinto(self._view[:size])
+        return self._view[:count]
+
+class KeepAliveHandler(urllib2.HTTPHandler):
+    """HTTP handler reusing persistent connections.
+
+    Instead of opening a new connection for every request, this handler
+    keeps the connections whose responses have been completely read in a
+    pool, indexed by host, and reuses them for later requests to the same
+    host using HTTP/1.1 persistent connections. When a proxy handler is
+    installed in the same opener, the host is the proxy one, so every
+    request is sent through the pool of connections to the proxy.
+
+    Idle connections the server has closed are discarded before reuse.
+    If a request still fails on a reused connection, it is retried once
+    on a new connection when it is a GET or HEAD request, or when it
+    could not be sent, as other requests (like a login form) may already
+    have been processed.
+
+    Host name resolutions are cached for dns_ttl seconds. The stats()
+    method returns the number of requests, reused connections, new
+    connections and name resolution cache hits and misses.
+    """
+
+    _pool = None
+    _pool_lock = None
+    _max_idle = None
+    _dns_cache = None
+    _dns_ttl = None
+    _stats = None
+
+    def __init__(self, max_idle=8, dns_ttl=300):
+        urllib2.HTTPHandler.__init__(self)
+        self._pool = {}
+        self._pool_lock = threading.Lock()
+        self._max_idle = max_idle
+        self._dns_cache = {}
+        self._dns_ttl = dns_ttl
+        self._stats = {
+            'requests': 0,
+            'reused': 0,
+            'connects': 0,
+            'dns_hits': 0,
+            'dns_lookups': 0,
+        }
+
+    def stats(self):
+        """Returns a copy of the pool statistics."""
+        self._pool_lock.acquire()
+        try:
+            return dict(self._stats)
+        finally:
+            self._pool_lock.release()
+
+    def getaddrinfo(self, host, port):
+        """Cached version of socket.getaddrinfo() for TCP connections."""
+        key = (host, port)
+        now = time.time()
+        self._pool_lock.acquire()
+        try:
+            entry = self._dns_cache.get(key, None)
+            if entry is not None and entry[0] > now:
+                self._stats['dns_hits'] += 1
+                return entry[1]
+            self._stats['dns_lookups'] += 1
+        finally:
+            self._pool_lock.release()
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        self._pool_lock.acquire()
+        try:
+            self._dns_cache[key] = (now + self._dns_ttl, addresses)
+        finally:
+            self._pool_lock.release()
+        return addresses
+
+    def forget_address(self, host, port):
+        """Remove a cached name resolution."""
+        self._pool_lock.acquire()
+        try:
+            self._dns_cache.pop((host, port), None)
+        finally:
+            self._pool_lock.release()
+
+    @staticmethod
+    def _is_stale(conn):
+        """Checks if an idle connection was closed by the server."""
+        if conn.sock is None:
+            return True
+        try:
+            # Idle connections have nothing to read, unless closed
+            return len(select.select([conn.sock], [], [], 0)[0]) > 0
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def _get_connection(self, host, fresh=False):
+        """Return a (connection, reused) pair for the given host.
+
+        If fresh is True, the connection is always a new one.
+        """
+        stale = []
+        self._pool_lock.acquire()
+        try:
+            self._stats['requests'] += 1
+            idle = self._pool.get(host, [])
+            while len(idle) > 0 and not fresh:
+                conn = idle.pop()
+                if self._is_stale(conn):
+                    stale.append(conn)
+                    continue
+                self._stats['reused'] += 1
+                return (conn, True)
+            self._stats['connects'] += 1
+        finally:
+            self._pool_lock.release()
+            for conn in stale:
+                conn.close()
+        return (_PooledHTTPConnection(self, host), False)
+
+    def release_connection(self, host, conn):
+        """Put a connection back in the pool, or close it if it is full."""
+        self._pool_lock.acquire()
+        try:
+            idle = self._pool.setdefault(host, [])
+            if len(idle) < self._max_idle:
+                idle.append(conn)
+                return
+        finally:
+            self._pool_lock.release()
+        conn.close()
+
+    def http_open(self, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        headers = dict(req.headers)
+        headers.update(req.unredirected_hdrs)
+        headers = dict([(name.title(), value) for (name, value) in headers.items()])
+
+        conn, reused = self._get_connection(host)
+        while True:
+            sent = False
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data, headers)
+                sent = True
+                response = conn.getresponse()
+                break
+            except (socket.error, httplib.HTTPException), err:
+                conn.close()
+                # The server may have closed the connection while idle;
+                # retry once on a new one if repeating the request is safe
+                if not reused or (sent and req.get_method() not in ('GET', 'HEAD')):
+                    raise urllib2.URLError(err)
+                conn, reused = self._get_connection(host, True)
+
+        fp = _PooledResponse(self, host, conn, response)
+        resp = urllib.addinfourl(fp, response.msg, req.get_full_url())
+        resp.readinto = fp.readinto
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+class _PooledHTTPConnection(httplib.HTTPConnection):
+    """HTTP connection resolving names through a KeepAliveHandler cache."""
+
+    _handler = None
+
+    def __init__(self, handler, host):
+        httplib.HTTPConnection.__init__(self, host)
+        self._handler = handler
+
+    def connect(self):
+        err = socket.error('getaddrinfo returns an empty list')
+        for (family, socktype, proto, canonname, address) in self._handler.getaddrinfo(self.host, self.port):
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                sock.connect(address)
+                self.sock = sock
+                return
+            except socket.error, err:
+                if sock is not None:
+                    sock.close()
+        self._handler.forget_address(self.host, self.port)
+        raise err
+
+class _PooledResponse(object):
+    """File-like response giving its connection back when fully read."""
+
+    _handler = None
+    _host = None
+    _conn = None
+    _response = None
+    _buffer = ''
+
+    def __init__(self, handler, host, conn, response):
+        self._handler = handler
+        self._host = host
+        self._conn = conn
+        self._response = response
+        self._buffer = ''
+
+    def _check_finished(self):
+        if self._conn is not None and self._response.isclosed():
+            conn = self._conn
+            self._conn = None
+            if self._response.will_close:
+                conn.close()
+            else:
+                self._handler.release_connection(self._host, conn)
+
+    def read(self, amt=None):
+        if len(self._buffer) > 0:
+            if amt is None:
+                data = self._buffer + self._response.read()
+                self._buffer = ''
+            else:
+                data = self._buffer[:amt]
+                self._buffer = self._buffer[amt:]
+        else:
+            data = self._response.read(amt)
+        self._check_finished()
+        return data
+
+    def readinto(self, buffer):
+        """Read up to len(buffer) bytes into buffer, returning the count.
+
+        Bodies with a known length and no transfer encoding are received
+        from the socket straight into buffer. Otherwise the data is read
+        and copied.
+        """
+        response = self._response
+        if (len(self._buffer) == 0 and self._conn is not None and response.fp is not None
+                and not response.chunked and response.length is not None):
+            amt = min(len(buffer), response.length)
+            if amt == 0:
+                return 0
+            count = self._conn.sock.recv_into(buffer, amt)
+            if count == 0:
+                # Premature end of data; the connection can not be reused
+                self.close()
+                return 0
+            response.length -= count
+            if response.length == 0:
+                response.close()
+                self._check_finished()
+            return count
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def readline(self):
+        while True:
+            pos = self._buffer.find('\n')
+            if pos >= 0:
+                line = self._buffer[:pos + 1]
+                self._buffer = self._buffer[pos + 1:]
+                return line
+            data = self._response.read(1024)
+            self._check_finished()
+            if len(data) == 0:
+                line = self._buffer
+                self._buffer = ''
+                return line
+            self._buffer += data
+
+    def close(self):
+        self._response.close()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+class RateLimiter(object):
+    """Token bucket rate limiter shared by every transfer.
+
+    There is a bucket for the global rate limit and one for each host with
+    its own limit. Every bucket is refilled at its rate and holds at most
+    _WINDOW seconds worth of tokens, so transfers can never burst over the
+    limit for longer than that. Downloaded bytes are taken from the global
+    bucket and from the buckets of the hosts matching the server (the
+    host itself or one of its parent domains). When a bucket runs out of
+    tokens, it goes into debt and the caller sleeps until it is paid. Later
+    callers queue behind that debt, so the limit holds for the sum of all
+    the concurrent transfers.
+    """
+
+    _WINDOW = 0.5
+
+    _buckets = None
+    _lock = None
+
+    def __init__(self, rate=None, host_rates=None):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        if rate is not None:
+            self._buckets[None] = self._new_bucket(rate)
+        if host_rates is not None:
+            for host, host_rate in host_rates.items():
+                self._buckets[host.lower()] = self._new_bucket(host_rate)
+
+    def _new_bucket(self, rate):
+        """Returns a new [rate, capacity, tokens, last refill time] bucket."""
+        capacity = max(long(rate * self._WINDOW), 1)
+        return [float(rate), capacity, float(capacity), time.time()]
+
+    def _matching_buckets(self, host):
+        buckets = []
+        for name, bucket in self._buckets.items():
+            if name is None or host == name or host.endswith('.' + name):
+                buckets.append(bucket)
+        return buckets
+
+    def max_block_size(self, host):
+        """Returns the largest amount of bytes that should be read at once."""
+        return min([bucket[1] for bucket in self._matching_buckets(host)] + [4194304])
+
+    def consume(self, host, byte_count):
+        """Take byte_count tokens, sleeping if the limits are exceeded."""
+        delay = self.reserve(host, byte_count)
+        if delay > 0:
+            time.sleep(delay)
+
+    def reserve(self, host, byte_count):
+        """Take byte_count tokens, returning the seconds to wait before going on."""
+        delay = 0.0
+        self._lock.acquire()
+        try:
+            now = time.time()
+            for bucket in self._matching_buckets(host):
+                rate, capacity, tokens, last = bucket
+                tokens = min(float(capacity), tokens + (now - last) * rate) - byte_count
+                bucket[2] = tokens
+                bucket[3] = now
+                if tokens < 0:
+                    delay = max(delay, -tokens / rate)
+        finally:
+            self._lock.release()
+        return delay
+
+class DownloadArchive(object):
+    """Record of downloaded videos.
+
+    Every video is identified by an (extractor, video id) pair stored as
+    an "extractor id" line. The archive file keeps the lines sorted, so
+    membership is tested with a binary search over a memory map of the
+    file, without reading it. New records are appended to a journal file
+    (the archive filename plus ".journal") with a single write, and the
+    journal is merged into the sorted file once it grows over
+    _MAX_JOURNAL records, so most runs do not rewrite the archive.
+
+    Several processes can share the archive. Merges are done under a
+    lock file (the archive filename plus ".lock"), and skipped while
+    another process holds it. The journal being merged is renamed aside
+    first (to the archive filename plus ".merging"), so records added in
+    the meantime go to a new journal.
+    """
+
+    _MAX_JOURNAL = 10000
+    _STALE_LOCK = 600
+
+    _filename = None
+    _journal_filename = None
+    _merging_filename = None
+    _lock_filename = None
+    _journal = None
+    _map = None
+    _map_file = None
+    _lock = None
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._journal_filename = filename + '.journal'
+        self._merging_filename = filename + '.merging'
+        self._lock_filename = filename + '.lock'
+        self._lock = threading.Lock()
+        # A journal left aside by an interrupted merge still counts
+        self._journal = self._read_records(self._journal_filename) | self._read_records(self._merging_filename)
+        self._open_map()
+        if len(self._journal) > self._MAX_JOURNAL:
+            self._compact()
+
+    @staticmethod
+    def _record(video_key):
+        """Returns the line of a video key, encoding unicode strings as UTF-8."""
+        parts = []
+        for part in video_key:
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            parts.append(part)
+        return '%s %s' % tuple(parts)
+
+    @staticmethod
+    def _read_records(filename):
+        """Returns the set of complete lines in a journal file."""
+        records = set()
+        try:
+            journal_file = open(filename, 'r')
+            try:
+                for line in journal_file:
+                    if line.endswith('\n'):
+                        records.add(line[:-1])
+            finally:
+                journal_file.close()
+        except IOError:
+            pass
+        return records
+
+    def _append_records(self, records):
+        """Append records to the journal file with a single write.
+
+        Where files can be locked, the write is done holding a lock on the
+        journal, which is opened again if a merge set it aside meanwhile.
+        """
+        data = ''.join([record + '\n' for record in records])
+        written = False
+        while not written:
+            fd = os.open(self._journal_filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                if fcntl is None or self._is_journal(fd):
+                    os.write(fd, data)
+                    written = True
+            finally:
+                os.close(fd)
+
+    def _is_journal(self, fd):
+        """Checks if the open file fd is still the journal file."""
+        try:
+            return os.path.samestat(os.fstat(fd), os.stat(self._journal_filename))
+        except OSError:
+            return False
+
+    def _open_map(self):
+        self._map = None
+        self._map_file = None
+        try:
+            if os.path.getsize(self._filename) == 0:
+                return
+            self._map_file = open(self._filename, 'rb')
+            self._map = mmap.mmap(self._map_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, IOError, EnvironmentError):
+            self._map = None
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map_file.close()
+        self._map = None
+        self._map_file = None
+
+    def _map_contains(self, record):
+        """Binary search for record in the sorted archive file."""
+        if self._map is None:
+            return False
+        low = 0
+        high = len(self._map)
+        while low < high:
+            middle = (low + high) // 2
+            start = self._map.rfind('\n', 0, middle) + 1
+            end = self._map.find('\n', start)
+            if end < 0:
+                end = len(self._map)
+            line = self._map[start:end]
+            if line == record:
+                return True
+            if line < record:
+                low = end + 1
+            else:
+                high = start
+        return False
+
+    def contains(self, video_key):
+        """Checks if the (extractor, video id) pair has been recorded."""
+        record = self._record(video_key)
+        self._lock.acquire()
+        try:
+            return record in self._journal or self._map_contains(record)
+        finally:
+            self._lock.release()
+
+    def add(self, video_key):
+        """Records an (extractor, video id) pair."""
+        record = self._record(video_key)
+        self._lock.acquire()
+        try:
+            if record in self._journal or self._map_contains(record):
+                return
+            self._append_records([record])
+            self._journal.add(record)
+            if len(self._journal) > self._MAX_JOURNAL:
+                self._compact()
+        finally:
+            self._lock.release()
+
+    def _acquire_merge_lock(self):
+        """Create the lock file. Returns False if another process holds it."""
+        try:
+            os.close(os.open(self._lock_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666))
+            return True
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+        # Remove the lock of a process that died while merging
+        try:
+            if time.time() - os.path.getmtime(self._lock_filename) < self._STALE_LOCK:
+                return False
+            os.remove(self._lock_filename)
+            os.close(os.open(self._lock_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666))
+        except OSError:
+            return False
+        return True
+
+    def _compact(self):
+        """Merge the journal into the sorted archive file, if not locked."""
+        if not self._acquire_merge_lock():
+            return
+        try:
+            # A journal already aside is left by an interrupted merge
+            if not os.path.exists(self._merging_filename):
+                try:
+                    fd = os.open(self._journal_filename, os.O_RDONLY)
+                except OSError:
+                    return
+                try:
+                    # Wait for the writes in progress
+                    if fcntl is not None:
+                        fcntl.flock(fd, fcntl.LOCK_EX)
+                    os.rename(self._journal_filename, self._merging_filename)
+                finally:
+                    os.close(fd)
+            self._merge(self._read_records(self._merging_filename))
+            os.remove(self._merging_filename)
+        finally:
+            os.remove(self._lock_filename)
+            self._journal = self._read_records(self._journal_filename) | self._read_records(self._merging_filename)
+            self._close_map()
+            self._open_map()
+
+    def _merge(self, records):
+        """Write the archive file again with records added to it."""
+        self._close_map()
+        tmp_filename = self._filename + '.tmp'
+        journal = list(records)
+        journal.sort()
+        try:
+            archive_file = open(self._filename, 'r')
+        except IOError:
+            archive_file = []
+        outfile = open(tmp_filename, 'w')
+        try:
+            index = 0
+            last = None
+            for line in archive_file:
+                line = line.rstrip('\n')
+                while index < len(journal) and journal[index] < line:
+                    if journal[index] != last:
+                        outfile.write(journal[index] + '\n')
+                        last = journal[index]
+                    index += 1
+                if line != last and line != '':
+                    outfile.write(line + '\n')
+                    last = line
+            for record in journal[index:]:
+                if record != last:
+                    outfile.write(record + '\n')
+                    last = record
+        finally:
+            outfile.close()
+            if not isinstance(archive_file, list):
+                archive_file.close()
+        if os.name == 'nt' and os.path.exists(self._filename):
+            os.remove(self._filename)
+        os.rename(tmp_filename, self._filename)
+
+class ExtractionCache(object):
+    """Persistent cache of extraction results and web pages.
+
+    Each entry is stored in its own file inside the cache directory, named
+    after a hash of its key, together with the time it was stored. Entries
+    older than ttl seconds are treated as missing. When the total size of
+    the entries grows over max_size bytes, the least recently used ones
+    (the ones with the oldest modification time, which is updated every
+    time an entry is read) are removed.
+    """
+
+    _directory = None
+    _ttl = None
+    _max_size = None
+    _total_size = None
+    _lock = None
+
+    def __init__(self, directory, ttl, max_size):
+        self._directory = directory
+        self._ttl = ttl
+        self._max_size = max_size
+        self._total_size = None
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self._directory, '%s.cache' % hashlib.sha1(repr(key)).hexdigest())
+
+    def _entries(self):
+        """Returns a list of (mtime, size, path) tuples for every entry."""
+        entries = []
+        for name in os.listdir(self._directory):
+            if not name.endswith('.cache'):
+                continue
+            path = os.path.join(self._directory, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, path))
+        return entries
+
+    def get(self, key):
+        """Returns the value stored for key, or None if missing or expired."""
+        path = self._path(key)
+        try:
+            entry_file = open(path, 'rb')
+            try:
+                stored_key, stored_time, value = cPickle.load(entry_file)
+            finally:
+                entry_file.close()
+        except (IOError, OSError, EOFError, ValueError, cPickle.UnpicklingError):
+            return None
+        if stored_key != key or time.time() - stored_time > self._ttl:
+            self._remove(path)
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """Stores value for key. Failures to write the entry are ignored."""
+        path = self._path(key)
+        tmp_path = '%s.%s.tmp' % (path, threading.currentThread().getName())
+        try:
+            if not os.path.isdir(self._directory):
+                os.makedirs(self._directory)
+            entry_file = open(tmp_path, 'wb')
+            try:
+                cPickle.dump((key, time.time(), value), entry_file, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                entry_file.close()
+            size = os.path.getsize(tmp_path)
+            if os.name == 'nt' and os.path.exists(path):
+                self._remove(path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError, cPickle.PicklingError):
+            self._remove(tmp_path)
+            return
+        self._lock.acquire()
+        try:
+            if self._total_size is None:
+                self._total_size = sum([x[1] for x in self._entries()])
+            else:
+                self._total_size += size
+            if self._total_size > self._max_size:
+                self._evict()
+        finally:
+            self._lock.release()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Remove the least recently used entries, leaving 10% free space."""
+        entries = self._entries()
+        entries.sort()
+        self._total_size = sum([x[1] for x in entries])
+        for mtime, size, path in entries:
+            if self._total_size <= self._max_size * 0.9:
+                break
+            self._remove(path)
+            self._total_size -= size
+
+class SpoolDaemon(object):
+    """Long-running loop downloading the URL lists put in a spool directory.
+
+    A job is a file whose name ends in ".job", holding URLs like a batch
+    file. To submit one atomically, write it under another name in the
+    same directory and then rename it. Jobs are processed one at a time,
+    oldest first, by the same FileDownloader, so its InfoExtractors are
+    initialized (and logged in) only once for all of them. While a job
+    runs, its file is renamed to end in ".running", and when it finishes,
+    to end in ".done", or ".failed" if there were errors. Jobs left running
+    by a daemon that was stopped are processed again on startup.
+    """
+
+    _INTERVAL = 1.0
+
+    _downloader = None
+    _directory = None
+
+    def __init__(self, downloader, directory):
+        self._downloader = downloader
+        self._directory = directory
+
+    def report_waiting(self):
+        """Report waiting for jobs."""
+        self._downloader.to_stdout(u'[daemon] Waiting for jobs in %s' % self._directory)
+
+    def report_job(self, path, status):
+        """Report the status of a job."""
+        self._downloader.to_stdout(u'[daemon] %s: %s' % (os.path.basename(os.path.splitext(path)[0]), status))
+
+    def _rename(self, path, suffix):
+        """Change the suffix of a job file. Returns the new path, or None."""
+        new_path = os.path.splitext(path)[0] + suffix
+        try:
+            if os.name == 'nt' and os.path.exists(new_path):
+                os.remove(new_path)
+            os.rename(path, new_path)
+        except OSError:
+            return None
+        return new_path
+
+    def _jobs(self, suffix):
+        """Returns the paths of the job files with suffix, oldest first."""
+        entries = []
+        for name in os.listdir(self._directory):
+            if not name.endswith(suffix):
+                continue
+            path = os.path.join(self._directory, name)
+            try:
+                entries.append((os.path.getmtime(path), name, path))
+            except OSError:
+                continue
+        entries.sort()
+        return [x[2] for x in entries]
+
+    def run(self):
+        """Process the jobs as they appear, forever."""
+        for path in self._jobs('.running'):
+            self._rename(path, '.job')
+        self.report_waiting()
+        while True:
+            job = None
+            for path in self._jobs('.job'):
+                job = self._rename(path, '.running')
+                if job is not None:
+                    break
+            if job is None:
+                time.sleep(self._INTERVAL)
+                continue
+            self.report_job(job, u'Starting')
+            success = self.run_job(job)
+            self.report_job(job, [u'Failed', u'Done'][success])
+            self._rename(job, ['.failed', '.done'][success])
+
+    def run_job(self, path):
+        """Download the URLs in a job file. Returns True if there were no errors."""
+        try:
+            jobfd = open(path, 'r')
+        except IOError, err:
+            self._downloader.to_stderr(u'ERROR: unable to read job: %s' % str(err))
+            return False
+        try:
+            try:
+                retcode = self._downloader.download(FileDownloader.read_batch_file(jobfd))
+            except DownloadError:
+                return False
+            except SameFileError:
+                self._downloader.to_stderr(u'ERROR: fixed output name but more than one file to download')
+                return False
+            except IOError, err:
+                self._downloader.to_stderr(u'ERROR: unable to read job: %s' % str(err))
+                return False
+        finally:
+            jobfd.close()
+        return retcode == 0
+
+class SessionStore(object):
+    """File-backed store of cookies and InfoExtractor sessions.
+
+    The file keeps the cookies of a cookielib.CookieJar, session cookies
+    included, together with the time every InfoExtractor session (see
+    InfoExtractor._session_key()) was set up. Sessions older than ttl
+    seconds are no longer valid. The file is only readable by its owner,
+    as the cookies can grant access to an account, and it is replaced
+    atomically when saved.
+    """
+
+    _filename = None
+    _ttl = None
+    _cookie_jar = None
+    _sessions = None
+    _lock = None
+
+    def __init__(self, filename, ttl, cookie_jar):
+        self._filename = filename
+        self._ttl = ttl
+        self._cookie_jar = cookie_jar
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            session_file = open(self._filename, 'rb')
+            try:
+                cookies, sessions = cPickle.load(session_file)
+            finally:
+                session_file.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError, cPickle.UnpicklingError):
+            return
+        now = time.time()
+        for cookie in cookies:
+            if not cookie.is_expired(now):
+                self._cookie_jar.set_cookie(cookie)
+        for key, set_up in sessions.items():
+            if now - set_up < self._ttl:
+                self._sessions[key] = set_up
+
+    @staticmethod
+    def _digest(session_key):
+        return hashlib.sha1(repr(session_key)).hexdigest()
+
+    def is_valid(self, session_key):
+        """Returns True if the session for session_key can be reused."""
+        set_up = self._sessions.get(self._digest(session_key), None)
+        return set_up is not None and time.time() - set_up < self._ttl
+
+    def add(self, session_key):
+        """Record a session set up now, and save it with the current cookies."""
+        self._sessions[self._digest(session_key)] = time.time()
+        self.save()
+
+    def save(self):
+        """Write the cookies and sessions to the file. Failures are ignored."""
+        self._lock.acquire()
+        try:
+            tmp_filename = '%s.tmp' % self._filename
+            try:
+                session_file = os.fdopen(os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb')
+                try:
+                    cPickle.dump((list(self._cookie_jar), dict(self._sessions)), session_file, cPickle.HIGHEST_PROTOCOL)
+                finally:
+                    session_file.close()
+                if os.name == 'nt' and os.path.exists(self._filename):
+                    os.remove(self._filename)
+                os.rename(tmp_filename, self._filename)
+            except (IOError, OSError, cPickle.PicklingError):
+                pass
+        finally:
+            self._lock.release()
+
+class TraceFile(object):
+    """Trace file recording how long every phase of the downloads takes.
+
+    Every phase is written as a span, a JSON object in its own line with
+    the phase name, the URL it concerns, its start and end times (seconds
+    since the epoch), its outcome ("ok", "error", or another word telling
+    why it was skipped) and some fields depending on the phase:
+
+    initialize:    InfoExtractor initialization (language, login, age
+            confirmation, etc). The URL is null. Fields: ie.
+    fetch:        Webpage request, "truncated" when the end of the page was
+            not needed (see PageRequest). Fields: bytes.
+    extract:    Extraction of the information for a URL, including its
+            initialization and fetches. The seconds spent running
+            the extractor code itself are in parse_time. The videos
+            of a playlist or search have the URL of the playlist or
+            search in parent, which is null otherwise. Fields: ie,
+            results, parse_time, parent.
+    download:    Transfer of a video file, from the video URL. Fields: id,
+            bytes (the size of the file on disk).
+    postprocess:    Postprocessing chain. The URL is the filename. Fields: id.
+            Postprocessors working on the data as it arrives run
+            during the download instead.
+
+    Spans also include the name of the thread they ran in. Lines are
+    written whole, so the spans from concurrent downloads do not mix.
+    """
+
+    _file = None
+    _lock = None
+
+    def __init__(self, filename):
+        self._file = open(filename, 'a')
+        self._lock = threading.Lock()
+
+    def write(self, phase, url, start, end, outcome, fields):
+        """Write a span. fields is a dictionary of additional fields."""
+        span = {
+            'phase':    phase,
+            'url':        url,
+            'start':    round(start, 6),
+            'end':        round(end, 6),
+            'outcome':    outcome,
+            'thread':    threading.currentThread().getName(),
+        }
+        span.update(fields)
+        line = json.dumps(span, sort_keys=True) + '\n'
+        self._lock.acquire()
+        try:
+            self._file.write(line)
+            self._file.flush()
+        finally:
+            self._lock.release()
+
+class JSONDump(object):
+    """Writer of the information of every video as JSON lines.
+
+    Every info dictionary passed to write() becomes a JSON object in its
+    own line. The lines are kept in a buffer, written in a single block
+    once it holds _BUFFER_SIZE bytes or _FLUSH_INTERVAL seconds after the
+    previous block, and by flush(). Long exports then avoid a write and a
+    flush per line, while the memory used stays bounded. Lines are
+    written whole, so the videos from concurrent extractions do not mix.
+    """
+
+    _BUFFER_SIZE = 65536
+    _FLUSH_INTERVAL = 1.0
+
+    _file = None
+    _lock = None
+    _buffer = None
+    _buffered = 0
+    _last_flush = None
+
+    def __init__(self, filename, stdout_lock=None):
+        """Write to filename, or to stdout if it is '-'.
+
+        Writes to stdout are done holding stdout_lock, if given, so the
+        lines do not mix with other output using the same lock.
+        """
+        self._lock = threading.Lock()
+        if filename == '-':
+            self._file = sys.stdout
+            if stdout_lock is not None:
+                self._lock = stdout_lock
+        else:
+            self._file = open(filename, 'a')
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = time.time()
+
+    def write(self, info_dict):
+        """Add the line of a video."""
+        line = json.dumps(info_dict, sort_keys=True) + '\n'
+        self._lock.acquire()
+        try:
+            self._buffer.append(line)
+            self._buffered += len(line)
+            if self._buffered >= self._BUFFER_SIZE or time.time() - self._last_flush >= self._FLUSH_INTERVAL:
+                self._flush()
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        """Write the buffered lines."""
+        self._lock.acquire()
+        try:
+            self._flush()
+        finally:
+            self._lock.release()
+
+    def _flush(self):
+        if len(self._buffer) > 0:
+            self._file.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        self._file.flush()
+        self._last_flush = time.time()
+
+class Metrics(object):
+    """Live counters and gauges of a FileDownloader.
+
+    The downloader feeds them with the spans of every phase (see
+    TraceFile) and with its progress hook events, and they are rendered
+    in the Prometheus text exposition format, to be served over HTTP
+    or written to a file. The throughput gauge is the average of the
+    last _SPEED_WINDOW seconds, so it falls to zero when the downloads
+    stall.
+    """
+
+    _SPEED_WINDOW = 10
+    _FILE_INTERVAL = 5.0
+
+    _lock = None
+    _start_time = None
+    _phases = None
+    _extraction_errors = None
+    _bytes = 0
+    _transfers = None
+    _recent = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._phases = {}
+        self._extraction_errors = {}
+        self._bytes = 0
+        self._transfers = {}
+        self._recent = collections.deque()
+
+    def add_span(self, phase, start, end, outcome, fields):
+        """Account for a phase going from start to end.
+
+        Only the extraction of the URLs given to the downloader counts, as
+        the extraction of a playlist or search includes its videos.
+        """
+        if phase == 'extract' and fields.get('parent', None) is not None:
+            return
+        self._lock.acquire()
+        try:
+            counts = self._phases.setdefault(phase, {})
+            counts[outcome] = counts.get(outcome, 0) + 1
+            counts[None] = counts.get(None, 0.0) + (end - start)
+            if phase == 'extract' and outcome == 'error':
+                ie = fields.get('ie', None)
+                self._extraction_errors[ie] = self._extraction_errors.get(ie, 0) + 1
+        finally:
+            self._lock.release()
+
+    def transfer_started(self, filename, resume_len):
+        self._lock.acquire()
+        try:
+            self._transfers[filename] = resume_len
+        finally:
+            self._lock.release()
+
+    def transfer_finished(self, filename):
+        self._lock.acquire()
+        try:
+            self._transfers.pop(filename, None)
+        finally:
+            self._lock.release()
+
+    def __call__(self, event):
+        """Progress hook counting the bytes received."""
+        filename = event['filename']
+        downloaded_bytes = event['downloaded_bytes']
+        self._lock.acquire()
+        try:
+            last = self._transfers.get(filename, None)
+            if last is None:
+                return
+            if downloaded_bytes < last:
+                # The file was truncated to be downloaded again
+                last = 0
+            self._transfers[filename] = downloaded_bytes
+            self._add_bytes(downloaded_bytes - last, time.time())
+        finally:
+            self._lock.release()
+
+    def _add_bytes(self, count, now):
+        """Count received bytes. Must be called with the lock held."""
+        self._bytes += count
+        second = long(now)
+        recent = self._recent
+        if len(recent) > 0 and recent[-1][0] == second:
+            recent[-1][1] += count
+        else:
+            recent.append([second, count])
+            while recent[0][0] <= second - self._SPEED_WINDOW:
+                recent.popleft()
+
+    def speed(self, now):
+        """Returns the average bytes/sec of the last _SPEED_WINDOW seconds."""
+        first = long(now) - self._SPEED_WINDOW
+        window = min(now - self._start_time, self._SPEED_WINDOW)
+        if window <= 0:
+            return 0.0
+        return sum([count for (second, count) in self._recent if second > first]) / window
+
+    @staticmethod
+    def _labels(**labels):
+        items = []
+        for name, value in sorted(labels.items()):
+            value = unicode(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+            items.append(u'%s="%s"' % (name, value))
+        return u'{%s}' % u','.join(items)
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format."""
+        metrics = []
+        def add(name, kind, help, samples):
+            metrics.append(u'# HELP youtube_dl_%s %s' % (name, help))
+            metrics.append(u'# TYPE youtube_dl_%s %s' % (name, kind))
+            for labels, value in samples:
+                metrics.append(u'youtube_dl_%s%s %s' % (name, labels, value))
+
+        self._lock.acquire()
+        try:
+            now = time.time()
+            phases = self._phases
+            extract = phases.get('extract', {})
+            download = phases.get('download', {})
+            add('urls_total', 'counter', 'URLs processed, by outcome.',
+                    [(self._labels(outcome=x), extract[x]) for x in sorted(extract) if x is not None])
+            add('extraction_errors_total', 'counter', 'URLs whose extraction failed, by extractor.',
+                    [(self._labels(extractor=x), self._extraction_errors[x]) for x in sorted(self._extraction_errors)])
+            add('downloads_total', 'counter', 'Video file downloads, by outcome.',
+                    [(self._labels(outcome=x), download[x]) for x in sorted(download) if x is not None])
+            add('downloaded_bytes_total', 'counter', 'Bytes of video data received.', [(u'', self._bytes)])
+            add('download_speed_bytes', 'gauge', 'Bytes/sec received in the last %d seconds.' % self._SPEED_WINDOW,
+                    [(u'', self.speed(now))])
+            add('transfers_in_flight', 'gauge', 'Video file downloads in progress.', [(u'', len(self._transfers))])
+            add('phase_seconds_total', 'counter', 'Seconds spent in every phase, added across threads.',
+                    [(self._labels(phase=x), phases[x][None]) for x in sorted(phases)])
+            add('uptime_seconds', 'gauge', 'Seconds since the downloader started.', [(u'', now - self._start_time)])
+        finally:
+            self._lock.release()
+        return (u'\n'.join(metrics) + u'\n').encode('utf-8')
+
+    def write_file(self, filename):
+        """Replace the contents of filename with the metrics."""
+        tmp_filename = filename + '.tmp'
+        try:
+            stats_file = open(tmp_filename, 'wb')
+            try:
+                stats_file.write(self.render())
+            finally:
+                stats_file.close()
+            if os.name == 'nt' and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError):
+            pass
+
+    def write_periodically(self, filename):
+        """Rewrite filename every _FILE_INTERVAL seconds from a thread."""
+        def writer():
+            while True:
+                self.write_file(filename)
+                time.sleep(self._FILE_INTERVAL)
+        thread = threading.Thread(target=writer, name='metrics-file')
+        thread.setDaemon(True)
+        thread.start()
+
+    def serve(self, port):
+        """Serve the metrics at http://127.0.0.1:port/metrics from a thread."""
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), _MetricsRequestHandler)
+        server.metrics = self
+        thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+        thread.setDaemon(True)
+        thread.start()
+        return server
+
+class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler serving the metrics of Metrics.serve()."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
 ### MAIN PROGRAM ###
 if __name__ == '__main__':
     try:
@@ -954,9 +4725,6 @@ if __name__ == '__main__':
         import optparse
 
         #General configureation
-        urllib2.install_opener(urllib2.build_opener(urllib2.ProxyHandler({'http':   http_proxy,
-                                                                          'https':  https_proxy,})))
-        #urllib2.install_opener(urllib2.build_opener(urllib2.HTTPCookieProcessor()))
         socket.setdefaulttimeout(300) #5 minutes should be enough (famous last words)
 
         #Parse command line
@@ -998,24 +4766,71 @@ if __name__ == '__main__':
                 action='store_true', dest='ignoreerrors', help='continue on download errors', default=False)
         parser.add_option('-r', '--rate-limit',
                 dest='ratelimit', metavar='L', help='download rate limit (e.g. 50k or 44.6m)')
+        parser.add_option('--host-rate-limit',
+                action='append', dest='hostratelimits', metavar='HOST=L', help='download rate limit for a host and its subdomains')
         parser.add_option('-a', '--batch-file',
-                dest='batchfile', metavar='F', help='file containing URLs to download')
+                dest='batchfile', metavar='F', help='file containing URLs to download (\'-\' for stdin)')
         parser.add_option('-w', '--no-overwrites',
                 action='store_true', dest='nooverwrites', help='do not overwrite files', default=False)
+        parser.add_option('--concurrent',
+                dest='concurrent', metavar='N', help='process N URLs (or videos of a single playlist or search) at the same time', default='1')
+        parser.add_option('--extract-ahead',
+                dest='extractahead', metavar='N', help='extract up to N videos ahead of the downloads', default='0')
+        parser.add_option('--segments',
+                dest='segments', metavar='N', help='download each file using N connections', default='1')
+        parser.add_option('--cache-dir',
+                dest='cachedir', metavar='DIR', help='cache extracted video information in DIR')
+        parser.add_option('--cache-ttl',
+                dest='cachettl', metavar='SECS', help='seconds cached information remains valid (default 3600)', default='3600')
+        parser.add_option('--cache-size',
+                dest='cachesize', metavar='SIZE', help='maximum size of the cache (e.g. 50m, default 100m)', default='100m')
+        parser.add_option('--download-archive',
+                dest='downloadarchive', metavar='FILE', help='skip videos recorded in FILE and record the downloaded ones')
+        parser.add_option('--event-loop',
+                action='store_true', dest='eventloop', help='run every download in a single thread with non-blocking requests', default=False)
+        parser.add_option('--trace',
+                dest='trace', metavar='FILE', help='append the timing of every phase to FILE, as JSON lines')
+        parser.add_option('--metrics-port',
+                dest='metricsport', metavar='PORT', help='serve live metrics at http://127.0.0.1:PORT/metrics')
+        parser.add_option('--prefetch-pages',
+                dest='prefetchpages', metavar='N', help='fetch up to N search or playlist pages at the same time (default 1)', default='1')
+        parser.add_option('--session-file',
+                dest='sessionfile', metavar='FILE', help='keep cookies and logins in FILE between runs')
+        parser.add_option('--session-ttl',
+                dest='sessionttl', metavar='SECS', help='seconds a saved login remains valid (default 86400)', default='86400')
+        parser.add_option('--spool-dir',
+                dest='spooldir', metavar='DIR', help='run as a daemon downloading the URL lists put in DIR as .job files')
+        parser.add_option('--dump-json',
+                dest='dumpjson', metavar='FILE', help='simulate, but append the information of every video to FILE as JSON lines (\'-\' for stdout, implying quiet)')
+        parser.add_option('--fast-metadata',
+                action='store_true', dest='fastmetadata', help='only resolve video URLs and titles, as fast as possible', default=False)
+        parser.add_option('--metrics-file',
+                dest='metricsfile', metavar='FILE', help='rewrite FILE with the live metrics every 5 seconds')
         (opts, args) = parser.parse_args()
 
         # Batch file verification
         batchurls = []
         if opts.batchfile is not None:
             try:
-                batchurls = [line.strip() for line in open(opts.batchfile, 'r')]
+                if opts.batchfile == '-':
+                    batchfd = sys.stdin
+                else:
+                    batchfd = open(opts.batchfile, 'r')
+                batchurls = FileDownloader.read_batch_file(batchfd)
             except IOError:
                 sys.exit(u'ERROR: batch file could not be read')
-        all_urls = batchurls + args
+        all_urls = itertools.chain(batchurls, args)
 
         # Conflicting, missing and erroneous options
-        if len(all_urls) < 1:
-            sys.exit(u'ERROR: you must provide at least one URL')
+        try:
+            all_urls = itertools.chain([all_urls.next()], all_urls)
+            if opts.spooldir is not None:
+                sys.exit(u'ERROR: giving URLs conflicts with using a spool directory')
+        except StopIteration:
+            if opts.spooldir is None:
+                sys.exit(u'ERROR: you must provide at least one URL')
+        except IOError:
+            sys.exit(u'ERROR: batch file could not be read')
         if opts.usenetrc and (opts.username is not None or opts.password is not None):
             sys.exit(u'ERROR: using .netrc conflicts with giving username/password')
         if opts.password is not None and opts.username is None:
@@ -1031,6 +4846,67 @@ if __name__ == '__main__':
             if numeric_limit is None:
                 sys.exit(u'ERROR: invalid rate limit specified')
             opts.ratelimit = numeric_limit
+        if opts.hostratelimits is not None:
+            host_limits = {}
+            for host_limit in opts.hostratelimits:
+                host, sep, limit = host_limit.partition('=')
+                numeric_limit = FileDownloader.parse_bytes(limit)
+                if host == '' or numeric_limit is None:
+                    sys.exit(u'ERROR: invalid host rate limit specified: %s' % host_limit)
+                host_limits[host] = numeric_limit
+            opts.hostratelimits = host_limits
+        try:
+            opts.concurrent = int(opts.concurrent)
+            if opts.concurrent < 1:
+                raise ValueError
+        except ValueError:
+            sys.exit(u'ERROR: invalid number of concurrent downloads specified')
+        try:
+            opts.extractahead = int(opts.extractahead)
+            if opts.extractahead < 0:
+                raise ValueError
+        except ValueError:
+            sys.exit(u'ERROR: invalid number of videos to extract ahead specified')
+        try:
+            opts.prefetchpages = int(opts.prefetchpages)
+            if opts.prefetchpages < 1:
+                raise ValueError
+        except ValueError:
+            sys.exit(u'ERROR: invalid number of pages to prefetch specified')
+        try:
+            opts.segments = int(opts.segments)
+            if opts.segments < 1:
+                raise ValueError
+        except ValueError:
+            sys.exit(u'ERROR: invalid number of segments specified')
+        try:
+            opts.cachettl = int(opts.cachettl)
+            if opts.cachettl < 0:
+                raise ValueError
+        except ValueError:
+            sys.exit(u'ERROR: invalid cache TTL specified')
+        opts.cachesize = FileDownloader.parse_bytes(opts.cachesize)
+        if opts.cachesize is None:
+            sys.exit(u'ERROR: invalid cache size specified')
+        try:
+            opts.sessionttl = int(opts.sessionttl)
+            if opts.sessionttl < 0:
+                raise ValueError
+        except ValueError:
+            sys.exit(u'ERROR: invalid session TTL specified')
+        if opts.metricsport is not None:
+            try:
+                opts.metricsport = int(opts.metricsport)
+                if opts.metricsport < 1 or opts.metricsport > 65535:
+                    raise ValueError
+            except ValueError:
+                sys.exit(u'ERROR: invalid metrics port specified')
+        if opts.spooldir is not None and not os.path.isdir(opts.spooldir):
+            sys.exit(u'ERROR: spool directory does not exist')
+        if opts.trace is not None and json is None:
+            sys.exit(u'ERROR: tracing requires the json module (Python 2.6 or later)')
+        if opts.dumpjson is not None and json is None:
+            sys.exit(u'ERROR: dumping JSON requires the json module (Python 2.6 or later)')
 
         # Information extractors
         youtube_ie = YoutubeIE()
@@ -1046,10 +4922,11 @@ if __name__ == '__main__':
                         'usenetrc': opts.usenetrc,
                         'username': opts.username,
                         'password': opts.password,
-                        'quiet': opts.quiet,
+                        'quiet': (opts.quiet or opts.geturl or opts.gettitle or opts.dumpjson == '-'),
                         'forceurl': opts.geturl,
                         'forcetitle': opts.gettitle,
-                        'simulate': opts.simulate,
+                        'simulate': (opts.simulate or opts.geturl or opts.gettitle or opts.dumpjson is not None),
+                        'fastmetadata': opts.fastmetadata,
                         'format': opts.format,
                         'outtmpl': (opts.outtmpl is not None and opts.outtmpl.decode(charset)
                             or (opts.usetitle and u'%(stitle)s-%(id)s.%(ext)s')
@@ -1057,11 +4934,34 @@ if __name__ == '__main__':
                             or u'%(id)s.%(ext)s'),
                         'ignoreerrors': opts.ignoreerrors,
                         'ratelimit':    opts.ratelimit,
-                        'nooverwrites': opts.nooverwrites,})
+                        'hostratelimits': opts.hostratelimits,
+                        'nooverwrites': opts.nooverwrites,
+                        'concurrent': opts.concurrent,
+                        'extractahead': opts.extractahead,
+                        'prefetchpages': opts.prefetchpages,
+                        'segments': opts.segments,
+                        'cachedir': opts.cachedir,
+                        'cachettl': opts.cachettl,
+                        'cachesize': opts.cachesize,
+                        'downloadarchive': opts.downloadarchive,
+                        'eventloop': opts.eventloop,
+                        'proxy': http_proxy,
+                        'trace': opts.trace,
+                        'dumpjson': opts.dumpjson,
+                        'sessionfile': opts.sessionfile,
+                        'sessionttl': opts.sessionttl,
+                        'metricsport': opts.metricsport,
+                        'metricsfile': opts.metricsfile,})
         fd.add_info_extractor(youtube_search_ie)
         fd.add_info_extractor(youtube_pl_ie)
         fd.add_info_extractor(metacafe_ie)
         fd.add_info_extractor(youtube_ie)
+        urllib2.install_opener(urllib2.build_opener(urllib2.ProxyHandler({'http':   http_proxy,
+                                                                          'https':  https_proxy,}),
+                                                    KeepAliveHandler(),
+                                                    urllib2.HTTPCookieProcessor(fd.cookie_jar())))
+        if opts.spooldir is not None:
+            SpoolDaemon(fd, opts.spooldir).run()
         retcode = fd.download(all_urls)
         sys.exit(retcode)
     except DownloadError: